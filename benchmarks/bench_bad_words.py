@@ -0,0 +1,46 @@
+# Compares the one-pass bad word scrubber against the old per-word loop
+# Run from the repo root: python -m benchmarks.bench_bad_words
+import re
+import random
+from timeit import timeit
+from dggpt.config import BAD_WORDS
+from dggpt.gpt.moderation import remove_bad_words
+
+FILLER = "the chat is saying that he has no idea what he's talking about lol".split()
+
+
+def legacy_remove_bad_words(message: str) -> str:
+    for bad_pattern in legacy_patterns:
+        if bad_pattern.search(message):
+            message = bad_pattern.sub("_", message)
+    return message
+
+
+legacy_patterns = [re.compile(rf"\b{word}\b", re.IGNORECASE) for word in BAD_WORDS]
+
+
+def make_log(lines: int, seed: int = 71) -> str:
+    rng = random.Random(seed)
+    vocab = FILLER * 20 + [word.upper() for word in BAD_WORDS] + list(BAD_WORDS)
+    log = []
+    for _ in range(lines):
+        words = rng.choices(vocab, k=rng.randint(4, 30))
+        log.append(f"user{rng.randint(1, 2)}: {' '.join(words)}")
+    return "\n".join(log)
+
+
+def main():
+    for lines in (50, 500, 5000):
+        log = make_log(lines)
+        assert remove_bad_words(log) == legacy_remove_bad_words(log)
+        runs = max(1, 5000 // lines)
+        legacy = timeit(lambda: legacy_remove_bad_words(log), number=runs) / runs
+        current = timeit(lambda: remove_bad_words(log), number=runs) / runs
+        print(
+            f"{len(log):>8} chars: legacy {legacy * 1000:8.3f} ms, "
+            f"one pass {current * 1000:8.3f} ms ({legacy / current:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+# Times the per-message hot paths on synthetic chat, with no network access
+# Run from the repo root: python -m benchmarks.bench_hot_paths [--json out.json]
+#   [--compare baseline.json] [--tolerance 1.25]
+import sys
+import json
+import random
+import argparse
+import platform
+import subprocess
+from re import compile as compile_regex
+from pathlib import Path
+from statistics import mean, median
+from time import perf_counter
+from typing import Callable
+from emoji import replace_emoji
+from dggpt.dgg import format_dgg_message, will_trigger_bot_filter
+from dggpt.dgg.formatter import _emoji_alternation
+from dggpt.dgg import moderation
+from dggpt.dgg.history import ChatHistory, band_keys, normalize
+from dggpt.gpt.convo import Convo, trim_tokens
+from dggpt.gpt.moderation import remove_bad_words
+from dggpt.gpt.tokens import count_tokens, get_encoding
+from dggpt.request import parse_phrases, request_emotes, request_phrases
+from dggpt.tts import format_tts_message
+
+FIXTURES = Path(__file__).parent / "fixtures"
+SEED = 71
+MESSAGES = 1000  # messages in the corpus each case runs over
+HISTORY = moderation.SPAM_SEARCH_AMOUNT
+CONVO_SIZES = (10, 100, 1000)
+MAX_TOKENS = 2500  # same as the bot's max_tokens
+ROUNDS = 5
+
+FILLER = (
+    "the chat is saying that he has no idea what he's talking about lol "
+    "did you guys see the debate yesterday it was actually so bad "
+    "i think destiny is right here but the other guy has a point "
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+).split()
+EMOJI = ("😂", "🤣", "👍", "🔥", "💀", "😭", "❤️", "👍🏽", "👨\u200d👩\u200d👧")
+# Edge cases format_dgg_message has to strip exactly like emoji.replace_emoji
+EMOJI_CASES = (
+    "a\u200db",  # a lone joiner is kept
+    "a\ufe0fb",  # a lone variation selector is removed
+    "👨\u200d👩 y",  # so is a joiner between emojis
+    "😂\u200da",
+    "a\u200d😂",
+    "#\ufe0f\u20e3 1\ufe0f",
+    "☺\ufe0e x",
+)
+
+
+def load_fixtures() -> None:
+    """Primes the phrase and emote caches so nothing is fetched"""
+    with open(FIXTURES / "phrases.json", "r") as phrases_json:
+        request_phrases.prime(parse_phrases(json.load(phrases_json)))
+    with open(FIXTURES / "emotes.json", "r") as emotes_json:
+        request_emotes.prime(tuple(json.load(emotes_json)))
+
+
+def make_corpus(count: int, rng: random.Random) -> list[str]:
+    """
+    Chat messages of mixed length, sprinkled with emotes, emoji,
+    banned phrases and newlines in roughly chat-like amounts.
+    """
+    emotes = request_emotes()
+    phrases = request_phrases()[0]
+    corpus = []
+    for _ in range(count):
+        words = rng.choices(FILLER, k=rng.choice((3, 6, 12, 25, 50)))
+        for _ in range(rng.randint(0, 3)):
+            words.insert(rng.randrange(len(words) + 1), rng.choice(emotes))
+        if rng.random() < 0.1:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(EMOJI))
+        if rng.random() < 0.05:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(phrases))
+        if rng.random() < 0.05:
+            words.insert(rng.randrange(len(words) + 1), "\n")
+        corpus.append(" ".join(words))
+    return corpus
+
+
+def make_history(corpus: list[str], rng: random.Random) -> ChatHistory:
+    history = ChatHistory(maxlen=HISTORY, min_length=moderation.SIMILARITY_INDEX_LEN)
+    for _ in range(HISTORY):
+        history.append(rng.choice(corpus))
+    return history
+
+
+def make_convo(size: int, corpus: list[str], rng: random.Random) -> list[dict]:
+    return [
+        {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"user{i % 7}: {rng.choice(corpus)}",
+        }
+        for i in range(size)
+    ]
+
+
+def check_emoji_parity(corpus: list[str]) -> int:
+    """Prints where emoji stripping differs from emoji.replace_emoji"""
+    pattern = compile_regex(_emoji_alternation())
+    mismatches = 0
+    for message in EMOJI_CASES + tuple(corpus):
+        if (new := pattern.sub("", message)) != (old := replace_emoji(message, "")):
+            mismatches += 1
+            print(f"Emoji mismatch: {message!r} -> {new!r}, expected {old!r}")
+    return mismatches
+
+
+def candidate_counts(history: ChatHistory, queries: list[str]) -> dict:
+    """How many older messages the index adds to the ones compared exactly"""
+    exact = min(moderation.SIMILARITY_EXACT_AMOUNT, len(history))
+    counts = [
+        len(history.candidates(normalize(query), exact)) - exact for query in queries
+    ]
+    return {
+        "mean": mean(counts),
+        "max": max(counts),
+        "indexed": sum(len(message) >= history.min_length for message in history),
+    }
+
+
+def check_recent_recall(history: ChatHistory, queries: list[str]) -> int:
+    """Prints the near duplicates of recent messages too_similar misses"""
+    exact = moderation.SIMILARITY_EXACT_AMOUNT
+    recent = ChatHistory(maxlen=exact, min_length=history.min_length)
+    for message in list(history)[-exact:]:
+        recent.append(message)
+    misses = 0
+    for query in queries:
+        if moderation.too_similar(query, recent) and not moderation.too_similar(
+            query, history
+        ):
+            misses += 1
+            print(f"Missed a near duplicate of a recent message: {query!r}")
+    return misses
+
+
+def time_case(func: Callable, inputs: list) -> dict:
+    """Runs func over every input ROUNDS times, in microseconds per call"""
+    rounds = []
+    for _ in range(ROUNDS):
+        start = perf_counter()
+        for item in inputs:
+            func(item)
+        rounds.append((perf_counter() - start) / len(inputs) * 1e6)
+    return {"min_us": min(rounds), "median_us": median(rounds), "calls": len(inputs)}
+
+
+def tokenizer_available() -> bool:
+    """The tokenizer is downloaded on first use, so it has to be cached already"""
+    try:
+        get_encoding()
+    except Exception:
+        return False
+    return True
+
+
+def run_cases() -> dict[str, dict]:
+    rng = random.Random(SEED)
+    corpus = make_corpus(MESSAGES, rng)
+    history = make_history(corpus, rng)
+    # Some near duplicates, so too_similar finds candidates as well as misses
+    queries = corpus[: MESSAGES // 2] + [
+        message[:-5] + "xyz" for message in rng.sample(list(history), MESSAGES // 2)
+    ]
+    log = "\n".join(f"user{i % 7}: {message}" for i, message in enumerate(corpus))
+    if mismatches := check_emoji_parity(corpus):
+        print(f"{mismatches} messages strip emojis differently than before")
+    # Near duplicates of the newest messages, which have to be found every time
+    queries += [message[:-5] + "xyz" for message in list(history)[-100:]]
+    if misses := check_recent_recall(history, queries):
+        print(f"{misses} near duplicates of recent messages weren't found")
+    counts = candidate_counts(history, queries)
+    print(
+        f"LSH candidates per query: {counts['mean']:.1f} mean,"
+        f" {counts['max']} max, of {counts['indexed']} indexed"
+    )
+
+    cases: dict[str, tuple[Callable, list]] = {
+        "will_trigger_bot_filter": (
+            lambda message: will_trigger_bot_filter(message, history),
+            queries,
+        ),
+        "too_similar": (lambda m: moderation.too_similar(m, history), queries),
+        "band_keys": (lambda m: band_keys(normalize(m)), corpus),
+        "format_dgg_message": (format_dgg_message, corpus),
+        "format_tts_message": (format_tts_message, corpus),
+        "remove_bad_words": (remove_bad_words, corpus),
+        "remove_bad_words[log]": (remove_bad_words, [log]),
+    }
+    for check in (
+        moderation.unique,
+        moderation.repeated,
+        moderation.ascii,
+        moderation.bad_word,
+        moderation.tags_destiny_with_link,
+    ):
+        cases[check.__name__] = (check, queries)
+
+    results = {"candidates": counts}
+    if tokenizer_available():
+        for size in CONVO_SIZES:
+            messages = make_convo(size, corpus, rng)
+            convo = Convo(messages)
+            runs = [None] * max(1, 1000 // size)
+            cases[f"Convo[{size}]"] = (lambda _, m=messages: Convo(m), runs)
+            cases[f"count_tokens[{size}]"] = (
+                lambda _, m=messages: count_tokens(m),
+                runs,
+            )
+            cases[f"count_tokens[Convo {size}]"] = (
+                lambda _, c=convo: count_tokens(c),
+                runs,
+            )
+            # Includes copying the convo, since trimming it works in place
+            cases[f"trim_tokens[{size}]"] = (
+                lambda _, c=convo: trim_tokens(c.copy(), MAX_TOKENS),
+                runs,
+            )
+    else:
+        print("Tokenizer isn't cached in config/tiktoken, skipping token cases")
+        results.update(
+            {
+                f"{name}[{size}]": {"skipped": "tokenizer not cached"}
+                for size in CONVO_SIZES
+                for name in ("Convo", "count_tokens", "trim_tokens")
+            }
+        )
+
+    # Last, since they change the history the other cases search
+    cases["history.append"] = (history.append, corpus)
+    # Everything a chat line costs, plus checking a response against the history
+    cases["per_message"] = (
+        lambda message: (
+            history.append(message),
+            will_trigger_bot_filter(message, history),
+        ),
+        corpus,
+    )
+    for name, (func, inputs) in cases.items():
+        results[name] = time_case(func, inputs)
+        print(f"{name:<28} {results[name]['min_us']:10.2f} us/call")
+    return results
+
+
+def metadata() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "seed": SEED,
+        "rounds": ROUNDS,
+    }
+
+
+def compare(results: dict, baseline_path: str, tolerance: float) -> int:
+    """Prints how each case moved against a baseline, returns the regressions"""
+    with open(baseline_path, "r") as baseline_json:
+        baseline: dict = json.load(baseline_json)["results"]
+    regressions = 0
+    for name, result in results.items():
+        old = baseline.get(name, {})
+        if "min_us" not in result or "min_us" not in old:
+            continue
+        ratio = result["min_us"] / old["min_us"]
+        regressed = ratio > tolerance
+        regressions += regressed
+        print(
+            f"{'SLOWER' if regressed else 'ok    '} {name:<28}"
+            f" {old['min_us']:10.2f} -> {result['min_us']:10.2f} us ({ratio:.2f}x)"
+        )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.25,
+        help="slowdown ratio that counts as a regression",
+    )
+    args = parser.parse_args()
+
+    load_fixtures()
+    results = run_cases()
+    if args.json:
+        with open(args.json, "w") as results_json:
+            json.dump({"meta": metadata(), "results": results}, results_json, indent=2)
+    if args.compare:
+        return compare(results, args.compare, args.tolerance)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
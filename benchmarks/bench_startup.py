@@ -0,0 +1,66 @@
+# Measures import time and memory of the bot's modules against targets
+# Run from the repo root: python -m benchmarks.bench_startup
+import sys
+import json
+import subprocess
+
+RUNS = 5
+
+# module: (max import seconds, max added RSS in MiB, modules it must not pull in)
+TARGETS = {
+    "dggpt": (0.05, 1, ("dggbot", "openai", "tiktoken", "elevenlabs")),
+    "dggpt.dgg": (0.5, 40, ("dggbot", "openai", "tiktoken", "elevenlabs")),
+    "dggpt.gpt": (1.0, 80, ("dggbot", "elevenlabs")),
+    "dggpt.dggpt": (1.5, 120, ("elevenlabs",)),
+}
+
+PROBE = """
+import sys, json, resource
+from time import perf_counter
+rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = perf_counter()
+__import__(sys.argv[1])
+seconds = perf_counter() - start
+rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+mib = (rss_after - rss_before) / 1024
+print(json.dumps({"seconds": seconds, "mib": mib, "modules": list(sys.modules)}))
+"""
+
+
+def measure(module: str) -> dict:
+    """Imports a module in a fresh interpreter, returns its best run"""
+    runs = []
+    for _ in range(RUNS):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE, module],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        runs.append(json.loads(output))
+    return min(runs, key=lambda run: run["seconds"])
+
+
+def main() -> int:
+    failures = 0
+    for module, (max_seconds, max_mib, forbidden) in TARGETS.items():
+        result = measure(module)
+        pulled_in = [
+            name
+            for name in forbidden
+            if any(m == name or m.startswith(name + ".") for m in result["modules"])
+        ]
+        ok = result["seconds"] <= max_seconds and result["mib"] <= max_mib
+        ok = ok and not pulled_in
+        failures += not ok
+        print(
+            f"{'ok  ' if ok else 'FAIL'} {module:<12}"
+            f" {result['seconds'] * 1000:7.1f} ms (target {max_seconds * 1000:.0f})"
+            f" {result['mib']:6.1f} MiB (target {max_mib})"
+            + (f" imported {', '.join(pulled_in)}" if pulled_in else "")
+        )
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+# Checks that replaying a convo's journal records rebuilds the same convo
+# Run from the repo root: python -m benchmarks.check_journal [--seed 71]
+#   [--runs 200] [--ops 50]
+import sys
+import json
+import random
+import argparse
+from collections import deque
+from typing import Callable
+from dggpt.gpt.convo import Convo, delete_last_prompt, trim_tokens
+from dggpt.gpt.tokens import get_encoding
+from dggpt.journal import apply
+
+MAX_LENGTH = 40
+
+
+class Messages:
+    """Numbered messages, so a mismatch shows which one went where"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, amount: int = 1) -> list[dict]:
+        messages = []
+        for _ in range(amount):
+            self.count += 1
+            role = "user" if self.count % 2 else "assistant"
+            messages.append({"role": role, "content": f"message {self.count}"})
+        return messages
+
+
+def random_index(convo: Convo, rng: random.Random) -> int:
+    """Any index, negative or past either end"""
+    return rng.randint(-len(convo) - 2, len(convo) + 2)
+
+
+def random_slice(convo: Convo, rng: random.Random, step: bool = False) -> slice:
+    return slice(
+        rng.choice((None, random_index(convo, rng))),
+        rng.choice((None, random_index(convo, rng))),
+        rng.choice((-2, -1, 2, 3)) if step else rng.choice((None, 1)),
+    )
+
+
+def random_op(
+    convo: Convo, rng: random.Random, new: Messages
+) -> tuple[str, Callable[[], object]]:
+    """A description of a random change to convo, and a function making it"""
+    index = random_index(convo, rng)
+    window = random_slice(convo, rng)
+    stepped = random_slice(convo, rng, step=True)
+    messages = new(rng.randint(0, 3))
+    ops = [
+        ("append", lambda: convo.append(new()[0])),
+        (f"extend {messages}", lambda: convo.extend(messages)),
+        (f"+= {messages}", lambda: convo.__iadd__(messages)),
+        (f"insert {index}", lambda: convo.insert(index, new()[0])),
+        (f"[{index}] =", lambda: convo.__setitem__(index, new()[0])),
+        (f"[{window}] = {messages}", lambda: convo.__setitem__(window, messages)),
+        (
+            f"[{stepped}] = same length",
+            lambda: convo.__setitem__(stepped, new(len(convo[stepped]))),
+        ),
+        (f"del [{index}]", lambda: convo.__delitem__(index)),
+        (f"del [{window}]", lambda: convo.__delitem__(window)),
+        (f"del [{stepped}]", lambda: convo.__delitem__(stepped)),
+        ("pop", lambda: convo.pop()),
+        (f"pop {index}", lambda: convo.pop(index)),
+        ("remove", lambda: convo.remove(rng.choice(convo))),
+        ("reverse", lambda: convo.reverse()),
+        ("sort", lambda: convo.sort(key=lambda message: message["content"])),
+        ("*= 2", lambda: convo.__imul__(2)),
+        ("delete_last_prompt", lambda: delete_last_prompt(convo)),
+        ("trim_tokens", lambda: trim_tokens(convo, convo.tokens // 2, keep=1)),
+    ]
+    if rng.random() < 0.02:
+        ops.append(("clear", lambda: convo.clear()))
+    return rng.choice(ops)
+
+
+def check_run(rng: random.Random, ops: int) -> list[str]:
+    """Makes ops random changes, returns what was done if the replay went wrong"""
+    new = Messages()
+    convo = Convo(new(rng.randint(0, 6)))
+    records = [["track", "convo", list(convo)]]
+    convo.on_change = lambda start, stop, messages: records.append(
+        ["splice", "convo", start, stop, messages]
+    )
+    done = []
+    for _ in range(ops):
+        description, op = random_op(convo, rng, new)
+        try:
+            op()
+        except (IndexError, ValueError):
+            # Failed the same way a list would, so nothing changed
+            continue
+        done.append(description)
+        # Capped so *= can't grow the convo without end
+        if len(convo) > MAX_LENGTH:
+            del convo[MAX_LENGTH:]
+            done.append(f"del [{MAX_LENGTH}:]")
+        replayed: dict[str, list[dict]] = {}
+        for record in records:
+            # Through JSON, since that's how the journal stores records
+            apply(replayed, deque(), json.loads(json.dumps(record)))
+        if replayed["convo"] != list(convo):
+            print(f"Replay differs after: {description}")
+            print(f"  live:     {[m['content'] for m in convo]}")
+            print(f"  replayed: {[m['content'] for m in replayed['convo']]}")
+            return done
+        if convo.tokens != Convo(list(convo)).tokens:
+            print(f"Token count differs after: {description}")
+            return done
+    return []
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=71)
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--ops", type=int, default=50, help="changes per run")
+    args = parser.parse_args()
+
+    try:
+        get_encoding()
+    except Exception:
+        print("Tokenizer isn't cached in config/tiktoken, can't build convos")
+        return 1
+    rng = random.Random(args.seed)
+    for run in range(args.runs):
+        if done := check_run(rng, args.ops):
+            print(f"Run {run} failed, changes made: {done}")
+            return 1
+    print(f"{args.runs} runs of {args.ops} changes replayed identically")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
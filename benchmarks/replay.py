@@ -0,0 +1,350 @@
+# Replays recorded DGG chat through the bot against local stubs of its APIs
+# Run from the repo root: python -m benchmarks.replay chat.jsonl [--speed 10]
+# Each line of the recording is {"nick": ..., "data": ..., "timestamp": ...}
+# with an optional "type" of "msg" (the default) or "privmsg".
+# The timestamp is unix seconds or an ISO 8601 string like rustlesearch's.
+# benchmarks/fixtures/chat.jsonl is a synthetic sample recording.
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+from time import monotonic, sleep
+from dggbot import Message
+from dggpt.metrics import Counter, Histogram, registry
+from .stubs import SERVICES, StubServer
+
+logger = logging.getLogger(__name__)
+
+REPO_CONFIG = Path(__file__).parent.parent / "config"
+LATE = 1.0  # seconds behind schedule before an event counts as delayed
+
+
+class SentLog:
+    """Stands in for the bot's websocket, keeping what it sends"""
+
+    def __init__(self):
+        self.frames: list[tuple[float, str]] = []
+        self._lock = Lock()
+
+    def send(self, frame: str) -> None:
+        with self._lock:
+            self.frames.append((monotonic(), frame))
+
+
+class Replay:
+    """Feeds a recording to a bot on schedule, timing each stage of handling it"""
+
+    def __init__(self, events: list[dict], speed: float, late: float = LATE):
+        self.events = events
+        self.speed = speed
+        self.late = late
+        self.lag = Histogram("replay_lag_seconds", "Time events were fed late")
+        self.handled = Histogram(
+            "replay_handler_seconds", "Time spent in each event handler"
+        )
+        self.delayed = Counter("replay_delayed_total", "Events handled late")
+        self.fed = 0
+        self.wall_time = 0.0
+
+    def attach(self, bot) -> None:
+        """Registers the same event handlers as main.py, with timing around them"""
+        self.bot = bot
+
+        @bot.event()
+        def on_msg(msg: Message):
+            received = self._received(msg, "msg")
+            with self.handled.time(handler="msg"):
+                bot.process_msg(msg.nick, msg.data, received)
+
+        @bot.event()
+        def on_mention(msg: Message):
+            self._received(msg, "mention")
+            with self.handled.time(handler="mention"):
+                bot.jobs.submit(bot.respond_to_mention, msg.nick, msg.data)
+
+        @bot.event()
+        def on_privmsg(msg: Message):
+            self._received(msg, "privmsg")
+            with self.handled.time(handler="privmsg"):
+                bot.jobs.submit(bot.process_privmsg, msg.nick, msg.data)
+
+    def _received(self, msg: Message, handler: str) -> float:
+        """Records how far behind schedule an event reached its handler"""
+        received = monotonic()
+        late = received - msg.get("due")
+        self.lag.observe(late, stage=handler)
+        if late > self.late:
+            self.delayed.inc(stage=handler)
+        return received
+
+    def run(self) -> None:
+        start = monotonic()
+        first = self.events[0]["timestamp"]
+        for event in self.events:
+            due = start + (event["timestamp"] - first) / self.speed
+            if (wait := due - monotonic()) > 0:
+                sleep(wait)
+            late = monotonic() - due
+            self.lag.observe(late, stage="feed")
+            if late > self.late:
+                self.delayed.inc(stage="feed")
+            frame_type = "PRIVMSG" if event.get("type") == "privmsg" else "MSG"
+            payload = {
+                "nick": event["nick"],
+                "data": event["data"],
+                "timestamp": int(event["timestamp"] * 1000),
+                "due": due,
+            }
+            self.bot._on_message(None, f"{frame_type} {json.dumps(payload)}")
+            self.fed += 1
+        self.wall_time = monotonic() - start
+
+
+def parse_timestamp(timestamp: float | str) -> float:
+    if isinstance(timestamp, str):
+        return datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp()
+    return float(timestamp)
+
+
+def read_recording(path: str, limit: int | None = None) -> list[dict]:
+    events = []
+    with open(path, "r", encoding="utf-8") as recording:
+        for line in recording:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            event["timestamp"] = parse_timestamp(event["timestamp"])
+            events.append(event)
+            if len(events) == limit:
+                break
+    events.sort(key=lambda event: event["timestamp"])
+    return events
+
+
+def make_workdir(admins: list[str]) -> str:
+    """
+    Copies the config folder somewhere temporary with stub keys,
+    so the replay never touches the real config or token ledger.
+    A cached tokenizer in config/tiktoken is copied along with it.
+    """
+    workdir = tempfile.mkdtemp(prefix="dggpt-replay-")
+    shutil.copytree(
+        REPO_CONFIG,
+        os.path.join(workdir, "config"),
+        ignore=shutil.ignore_patterns(
+            "config.json", "tokens.db*", "monthly_tokens.json", "journal"
+        ),
+    )
+    with open(os.path.join(workdir, "config", "config.json"), "w") as config_json:
+        json.dump(
+            {
+                "dgg_key": "replay",
+                "openai_key": "replay",
+                "elevenlabs_key": "replay",
+                "admins": admins,
+                "blacklist": [],
+            },
+            config_json,
+        )
+    shutil.copy(
+        REPO_CONFIG / "sample.quickdraw_record.json",
+        os.path.join(workdir, "config", "quickdraw_record.json"),
+    )
+    os.mkdir(os.path.join(workdir, "mp3files"))
+    return workdir
+
+
+def point_at_stubs(stubs: StubServer) -> dict:
+    """Sends every external request to the stubs, returns the DGGBot config"""
+    from dggpt import request
+
+    os.environ["OPENAI_BASE_URL"] = stubs.url("openai") + "/v1"
+    os.environ["ELEVENLABS_BASE_URL"] = stubs.url("elevenlabs")
+    request.LOG_LINK = stubs.url("rustlesearch") + "/anon/search"
+    request.PHRASE_LINK = stubs.url("vyneer") + "/tools/phrases?ts=1"
+    request.EMOTE_LINK = stubs.url("tena") + "/api/emotes"
+    return {
+        "wss": "ws://127.0.0.1:9/ws",
+        "wss-origin": stubs.url("dgg"),
+        "baseurl": stubs.url("dgg"),
+        "endpoints": {"user": "/api/chat/me", "userinfo": "/api/userinfo"},
+        "flairs": stubs.url("dgg") + "/flairs.json",
+    }
+
+
+def make_bot(dgg_config: dict, nick: str):
+    from dggpt import DGGPTBot
+
+    class ReplayBot(DGGPTBot):
+        def update_live_status(self):
+            """The live status would need a websocket of its own"""
+
+    bot = ReplayBot(config=dgg_config)
+    bot.ws = SentLog()
+    bot._on_message(None, "ME " + json.dumps({"id": 1, "nick": nick}))
+    return bot
+
+
+def drain(bot, timeout: float) -> bool:
+    """Waits for queued jobs, TTS clips and messages, returns False on timeout"""
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        tts_pending = 0
+        if "dggpt.tts.tts" in sys.modules:
+            tts_pending = len(sys.modules["dggpt.tts.tts"].tts_queue())
+        if bot.jobs.pending == 0 and tts_pending == 0 and len(bot.outbox) == 0:
+            return True
+        sleep(0.05)
+    return False
+
+
+def report(replay: Replay, bot, stubs: StubServer, drained: bool) -> dict:
+    def label(label_set: tuple) -> str:
+        return "/".join(value for _, value in label_set)
+
+    recorded = replay.events[-1]["timestamp"] - replay.events[0]["timestamp"]
+    metrics = (replay.lag, replay.handled, replay.delayed, *registry.metrics.values())
+    stages = {
+        metric.name: {
+            label(label_set): {"p50": p50, "p95": p95, "max": p100}
+            for label_set, (p50, p95, p100) in metric.quantiles(0.5, 0.95, 1).items()
+        }
+        for metric in metrics
+        if isinstance(metric, Histogram)
+    }
+    counters = {
+        metric.name: {
+            label(label_set): value for label_set, value in metric.values().items()
+        }
+        for metric in metrics
+        if isinstance(metric, Counter)
+    }
+    tts = sys.modules.get("dggpt.tts.tts")
+    return {
+        "events": replay.fed,
+        "recorded_seconds": recorded,
+        "wall_seconds": replay.wall_time,
+        "events_per_second": replay.fed / replay.wall_time if replay.wall_time else 0,
+        "achieved_speed": recorded / replay.wall_time if replay.wall_time else 0,
+        "drained": drained,
+        "jobs": bot.jobs.stats(),
+        "tts_dropped": tts.tts_queue().dropped if tts else 0,
+        "sent": len(bot.ws.frames),
+        "stages": stages,
+        "counters": counters,
+        "stub_requests": dict(stubs.requests),
+        "stub_errors": dict(stubs.injected_errors),
+    }
+
+
+def print_report(result: dict) -> None:
+    print(
+        f"{result['events']} events in {result['wall_seconds']:.1f}s"
+        f" ({result['events_per_second']:.1f}/s,"
+        f" {result['achieved_speed']:.1f}x real time)"
+        + ("" if result["drained"] else ", jobs still running at the end")
+    )
+    jobs = result["jobs"]
+    print(
+        f"jobs: {jobs['submitted']} submitted, {jobs['dropped']} dropped,"
+        f" {jobs['failed']} failed, tts clips dropped: {result['tts_dropped']},"
+        f" messages sent: {result['sent']}"
+    )
+    for name, label_sets in result["stages"].items():
+        for label, q in label_sets.items():
+            stage = name.removeprefix("dggpt_").removesuffix("_seconds")
+            print(
+                f"  {stage + ('/' + label if label else ''):<36}"
+                f" p50 {q['p50'] * 1000:9.1f} ms  p95 {q['p95'] * 1000:9.1f} ms"
+                f"  max {q['max'] * 1000:9.1f} ms"
+            )
+    for name, values in result["counters"].items():
+        if values:
+            print(f"  {name}: {values}")
+    print(f"  stub requests: {result['stub_requests']}")
+    if result["stub_errors"]:
+        print(f"  stub errors: {result['stub_errors']}")
+
+
+def service_values(text: str) -> dict[str, float]:
+    """Parses "openai=0.8,elevenlabs=0.3" """
+    values = {}
+    for pair in filter(None, text.split(",")):
+        service, _, value = pair.partition("=")
+        if service not in SERVICES:
+            raise argparse.ArgumentTypeError(f"unknown service {service}")
+        values[service] = float(value)
+    return values
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recording", help="JSONL file of recorded chat")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed-up")
+    parser.add_argument("--limit", type=int, help="only replay this many events")
+    parser.add_argument("--nick", default="GPT71", help="the bot's nick in chat")
+    parser.add_argument("--admins", default="", help="comma separated admin nicks")
+    parser.add_argument(
+        "--latency",
+        type=service_values,
+        default={"openai": 0.8, "elevenlabs": 0.4, "rustlesearch": 0.3},
+        help='mean seconds per service, e.g. "openai=0.8,vyneer=0.2"',
+    )
+    parser.add_argument(
+        "--errors",
+        type=service_values,
+        default={},
+        help='fraction of failed requests per service, e.g. "openai=0.05"',
+    )
+    parser.add_argument("--flag-rate", type=float, default=0.02)
+    parser.add_argument("--late", type=float, default=LATE)
+    parser.add_argument("--drain", type=float, default=60, help="seconds to wait")
+    parser.add_argument("--cooldown", type=int, help="override the bot's cooldown")
+    parser.add_argument("--tts", action="store_true", help="replay in TTS mode")
+    parser.add_argument("--stream", action="store_true", help="stream completions")
+    parser.add_argument("--speculative", action="store_true")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "ERROR"))
+    for logger_name in ("websocket", "httpx", "dgg-bot"):
+        logging.getLogger(logger_name).disabled = True
+
+    events = read_recording(args.recording, args.limit)
+    if not events:
+        print("The recording is empty")
+        return 1
+    stubs = StubServer(args.latency, args.errors, args.flag_rate).start()
+    dgg_config = point_at_stubs(stubs)
+    workdir = make_workdir(list(filter(None, args.admins.split(","))))
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        bot = make_bot(dgg_config, args.nick)
+        if args.cooldown is not None:
+            bot.cooldown = args.cooldown
+        bot.tts_mode = args.tts
+        bot.stream_mode = args.stream
+        bot.speculative_mode = args.speculative
+        replay = Replay(events, args.speed, args.late)
+        replay.attach(bot)
+        replay.run()
+        drained = drain(bot, args.drain)
+        result = report(replay, bot, stubs, drained)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as report_json:
+            json.dump(result, report_json, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
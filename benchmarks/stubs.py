@@ -0,0 +1,247 @@
+# Local stand-ins for openai, elevenlabs, rustlesearch, vyneer, tena.dev and dgg
+# Used by benchmarks.replay, every service is served under its own path prefix
+import json
+import random
+import logging
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Lock, Thread
+from time import sleep, time
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+FIXTURES = Path(__file__).parent / "fixtures"
+SERVICES = ("openai", "elevenlabs", "rustlesearch", "vyneer", "tena", "dgg")
+TOKEN_INTERVAL = 0.02  # seconds between streamed completion chunks
+AUDIO_CHUNKS = 8
+SEARCH_PAGES = 3  # pages of results for every rustlesearch query
+SEARCH_PAGE_SIZE = 20
+VOICE_ID = "stubvoice0000000000"
+
+RESPONSES = (
+    "I think that's a pretty reasonable take, but the details matter a lot here",
+    "nah that's not how any of that works PepeLaugh",
+    "honestly it depends on who you ask, chat is split on this one",
+    "source? I've never heard of that before MMMM",
+    "that's the funniest thing I've read all day LUL",
+    "I'm not going to answer that one Klappa",
+    "you'd have to ask Destiny about that, I'm just a bot",
+    "there are good arguments on both sides but I lean towards no",
+)
+FLAG_CATEGORIES = ("harassment", "hate", "violence", "self_harm", "sexual")
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    One HTTP server for every external API the bot talks to.
+    latency is the mean seconds each service takes to start responding,
+    errors the fraction of its requests that fail with a 500,
+    and flag_rate the fraction of prompts the moderation stub flags.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        latency: dict[str, float] | None = None,
+        errors: dict[str, float] | None = None,
+        flag_rate: float = 0.0,
+        seed: int = 71,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        super().__init__((host, port), _StubHandler)
+        self.latency = dict.fromkeys(SERVICES, 0.0) | (latency or {})
+        self.errors = dict.fromkeys(SERVICES, 0.0) | (errors or {})
+        self.flag_rate = flag_rate
+        self.requests: Counter[str] = Counter()
+        self.injected_errors: Counter[str] = Counter()
+        self._rng = random.Random(seed)
+        self._lock = Lock()
+        with open(FIXTURES / "phrases.json", "r") as phrases_json:
+            self.phrases: list[str] = json.load(phrases_json)
+        with open(FIXTURES / "emotes.json", "r") as emotes_json:
+            self.emotes: list[str] = json.load(emotes_json)
+
+    def url(self, service: str) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/{service}"
+
+    def start(self) -> "StubServer":
+        Thread(target=self.serve_forever, name="stubs", daemon=True).start()
+        logger.info(f"Serving stubs on {self.url('')}")
+        return self
+
+    def random(self) -> float:
+        with self._lock:
+            return self._rng.random()
+
+    def choice(self, items):
+        with self._lock:
+            return self._rng.choice(items)
+
+    def delay(self, service: str) -> bool:
+        """Sleeps for the service's latency, returns False if this request fails"""
+        with self._lock:
+            self.requests[service] += 1
+            jitter = self._rng.random()
+            if failed := self._rng.random() < self.errors[service]:
+                self.injected_errors[service] += 1
+        sleep(self.latency[service] * (0.5 + jitter))
+        return not failed
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    server: StubServer
+
+    def do_GET(self):
+        self._route()
+
+    def do_POST(self):
+        self._route()
+
+    def _route(self):
+        service, _, path = self.path.lstrip("/").partition("/")
+        path = "/" + path.split("?")[0]
+        routes = {
+            ("openai", "/v1/chat/completions"): self._chat,
+            ("openai", "/v1/moderations"): self._moderation,
+            ("openai", "/v1/images/generations"): self._image,
+            ("elevenlabs", "/v1/voices"): self._voices,
+            ("rustlesearch", "/anon/search"): self._search,
+            ("vyneer", "/tools/phrases"): self._phrases,
+            ("tena", "/api/emotes"): self._emotes,
+            ("dgg", "/flairs.json"): lambda: self._json([]),
+        }
+        if service == "elevenlabs" and path.startswith("/v1/text-to-speech/"):
+            handler = self._speech
+        elif (handler := routes.get((service, path))) is None:
+            self.send_error(404)
+            return
+        if not self.server.delay(service):
+            self._json(
+                {"error": {"message": "stub error", "type": "server_error"}}, 500
+            )
+            return
+        handler()
+
+    def _body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _json(self, data, status: int = 200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chat(self):
+        request = self._body()
+        content = self.server.choice(RESPONSES)
+        prompt_tokens = sum(
+            len(str(message.get("content", "")).split())
+            for message in request.get("messages", ())
+        )
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content.split()),
+            "total_tokens": prompt_tokens + len(content.split()),
+        }
+        base = {"id": "chatcmpl-stub", "created": int(time()), "model": "stub"}
+        if not request.get("stream"):
+            self._json(
+                base
+                | {
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                }
+            )
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        chunk = base | {"object": "chat.completion.chunk"}
+        try:
+            for i, word in enumerate(content.split(" ")):
+                delta = {"content": word if i == 0 else " " + word}
+                choice = {"index": 0, "delta": delta, "finish_reason": None}
+                self._event(chunk | {"choices": [choice]})
+                sleep(TOKEN_INTERVAL)
+            self._event(chunk | {"choices": [], "usage": usage})
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            logger.debug("Streamed completion was cancelled by the client")
+
+    def _event(self, data: dict):
+        self.wfile.write(f"data: {json.dumps(data)}\n\n".encode())
+        self.wfile.flush()
+
+    def _moderation(self):
+        self._body()
+        flagged = self.server.random() < self.server.flag_rate
+        flag = self.server.choice(FLAG_CATEGORIES) if flagged else None
+        categories = {category: category == flag for category in FLAG_CATEGORIES}
+        scores = {category: float(category == flag) for category in FLAG_CATEGORIES}
+        self._json(
+            {
+                "id": "modr-stub",
+                "model": "stub",
+                "results": [
+                    {
+                        "flagged": flagged,
+                        "categories": categories,
+                        "category_scores": scores,
+                    }
+                ],
+            }
+        )
+
+    def _image(self):
+        self._body()
+        self._json({"created": int(time()), "data": [{"url": "https://example.com/"}]})
+
+    def _voices(self):
+        self._json({"voices": [{"voice_id": VOICE_ID, "name": "Jessica"}]})
+
+    def _speech(self):
+        self._body()
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.end_headers()
+        for _ in range(AUDIO_CHUNKS):
+            self.wfile.write(bytes(1024))
+            self.wfile.flush()
+            sleep(TOKEN_INTERVAL)
+
+    def _search(self):
+        query = parse_qs(urlsplit(self.path).query)
+        newest = int(query.get("search_after", [SEARCH_PAGES * SEARCH_PAGE_SIZE])[0])
+        messages = [
+            {
+                "username": f"user{i % 3}",
+                "text": self.server.choice(RESPONSES),
+                "searchAfter": i,
+            }
+            for i in range(newest - 1, max(newest - SEARCH_PAGE_SIZE, 0) - 1, -1)
+        ]
+        self._json({"error": None, "data": {"messages": messages}})
+
+    def _phrases(self):
+        self._json({"data": [{"phrase": phrase} for phrase in self.server.phrases]})
+
+    def _emotes(self):
+        self._json(dict.fromkeys(self.server.emotes, {}))
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
@@ -1,2 +1,10 @@
 # Interacts with all of the other modules
-from .dggpt import DGGPTBot
+# Importing the bot is deferred so the tools can be used on their own
+
+
+def __getattr__(name: str):
+    if name == "DGGPTBot":
+        from .dggpt import DGGPTBot
+
+        return DGGPTBot
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,152 @@
+# In-memory caches shared by the bot's modules
+import logging
+from collections import OrderedDict
+from functools import update_wrapper
+from threading import Lock, Thread
+from time import monotonic
+from typing import Any, Callable, Hashable, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """A thread safe LRU cache whose entries also expire after ttl seconds"""
+
+    def __init__(self, maxsize: int, ttl: float | None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            stored_at, value = self._data.get(key, (0.0, _MISSING))
+            if value is not _MISSING and (
+                self.ttl is None or monotonic() - stored_at < self.ttl
+            ):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            if value is not _MISSING:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class _Snapshot(NamedTuple):
+    value: Any
+    derived: dict
+
+
+class RefreshingCache:
+    """
+    Caches the result of a function for ttl seconds.
+    Once it's stale, callers keep getting the current snapshot while a
+    background thread fetches the new one and swaps it in.
+    If a refresh fails, the last good snapshot is kept.
+    """
+
+    def __init__(self, func: Callable[[], Any], ttl: float | None, retry_after=60):
+        update_wrapper(self, func)
+        self._func = func
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self._snapshot: _Snapshot | None = None
+        self._fetched_at = 0.0
+        self._refreshing = False
+        self._lock = Lock()
+        self._load_lock = Lock()
+        self._derivations: list[Callable[[Any], Any]] = []
+
+    def __call__(self) -> Any:
+        return self.snapshot().value
+
+    def snapshot(self) -> _Snapshot:
+        if (snapshot := self._snapshot) is None:
+            with self._load_lock:
+                if self._snapshot is None:
+                    self._snapshot = self._build()
+                    self._fetched_at = monotonic()
+                return self._snapshot
+        if self.ttl is not None and monotonic() - self._fetched_at > self.ttl:
+            self.refresh()
+        return snapshot
+
+    def derive(self, func: Callable[[Any], Any]) -> Callable[[], Any]:
+        """
+        Returns a function that gives func(current value).
+        It's recomputed in the refresh thread along with every new value.
+        """
+        self._derivations.append(func)
+
+        def derived() -> Any:
+            snapshot = self.snapshot()
+            if func not in snapshot.derived:
+                snapshot.derived[func] = func(snapshot.value)
+            return snapshot.derived[func]
+
+        return update_wrapper(derived, func)
+
+    def prime(self, value: Any) -> None:
+        """Swaps in a value without calling the function, e.g. from a fixture"""
+        with self._load_lock:
+            self._snapshot = self._snapshot_of(value)
+            self._fetched_at = monotonic()
+
+    def refresh(self) -> None:
+        """Starts fetching a new value in the background, unless one is on its way"""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        Thread(
+            target=self._refresh, name=f"refresh-{self.__name__}", daemon=True
+        ).start()
+
+    def _refresh(self) -> None:
+        try:
+            self._snapshot = self._build()
+            self._fetched_at = monotonic()
+            logger.debug(f"Refreshed {self.__name__}")
+        except Exception:
+            logger.exception(f"Couldn't refresh {self.__name__}, keeping the old data")
+            if self.ttl is not None:
+                self._fetched_at = monotonic() - self.ttl + self.retry_after
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _build(self) -> _Snapshot:
+        return self._snapshot_of(self._func())
+
+    def _snapshot_of(self, value: Any) -> _Snapshot:
+        return _Snapshot(value, {func: func(value) for func in self._derivations})
+
+
+def refreshing_cache(ttl: float | None) -> Callable[[Callable], RefreshingCache]:
+    """Decorator form of RefreshingCache"""
+    return lambda func: RefreshingCache(func, ttl)
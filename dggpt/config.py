@@ -1,86 +1,260 @@
 # Handles reading/writing files in the config folder
 import os
 import json
+import atexit
 import logging
-from datetime import datetime
-from jsonschema import validate, ValidationError
+from functools import cache
+from threading import Condition, Thread
+from time import monotonic
+from jsonschema import Draft7Validator, ValidationError
+from .ledger import TokenLedger
 
 logger = logging.getLogger(__name__)
 
+CONFIG_PATH = "config/config.json"
+SET_KEYS = ("admins", "blacklist")  # kept as sets by the ConfigStore
+SAVE_DELAY = 2  # seconds without changes before they're written
+RELOAD_INTERVAL = 5  # seconds between checks for edits to the file
 
-with open("config/config.json", "r") as config_json:
-    config = json.load(config_json)
-    OPENAI_KEY = config["openai_key"]
-    ELEVENLABS_KEY = config["elevenlabs_key"]
 
-with open("config/system.txt", "r") as sys_txt:
-    SYSTEM = sys_txt.read()
+@cache
+def _keys() -> dict:
+    with open("config/config.json", "r") as config_json:
+        return json.load(config_json)
 
-with open("config/base_convo.json", "r") as base_json:
-    _base_list = [{"role": "system", "content": SYSTEM}] + json.load(base_json)
-    BASE_CONVO = tuple(_base_list)
-    BASE_LENGTH = len(BASE_CONVO)
 
-with open("config/base_summary.json", "r") as summarize_json:
-    BASE_SUMMARY = tuple(json.load(summarize_json))
+@cache
+def _system() -> str:
+    with open("config/system.txt", "r") as sys_txt:
+        return sys_txt.read()
 
-with open("config/bad_words.csv", "r") as bad_words_csv:
-    BAD_WORDS = tuple(bad_words_csv.read().split())
 
-with open("config/schema.config.json", "r") as schema_json:
-    _schema = json.load(schema_json)
+@cache
+def _base_convo() -> tuple[dict]:
+    with open("config/base_convo.json", "r") as base_json:
+        return tuple([{"role": "system", "content": _system()}] + json.load(base_json))
 
-logger.debug("Loaded constants from config files")
 
+@cache
+def _base_summary() -> tuple[dict]:
+    with open("config/base_summary.json", "r") as summarize_json:
+        return tuple(json.load(summarize_json))
 
-def read_config() -> dict[str, str | list]:
-    """Reads the config.json file, returns it as a dict"""
-    logger.debug("Reading config file")
-    with open("config/config.json", "r") as config_json:
-        config = json.load(config_json)
-    return config
+
+@cache
+def _bad_words() -> tuple[str]:
+    with open("config/bad_words.csv", "r") as bad_words_csv:
+        return tuple(bad_words_csv.read().split())
+
+
+@cache
+def _schema() -> dict:
+    with open("config/schema.config.json", "r") as schema_json:
+        return json.load(schema_json)
+
+
+@cache
+def _validator() -> Draft7Validator:
+    """Checks the schema once, so validating only checks the config"""
+    Draft7Validator.check_schema(_schema())
+    return Draft7Validator(_schema())
 
 
-def save_config(config: dict) -> None:
-    """Validates and writes a dict to the config.json file"""
-    logger.debug("Saving config file")
+def validate_config(config: dict) -> None:
     try:
-        validate(instance=config, schema=_schema)
+        _validator().validate(config)
     except ValidationError as e:
         raise ValueError(f"Invalid configuration data: {e.message}")
 
-    with open("config/config.json", "w") as config_json:
+
+def write_config(config: dict, path: str = CONFIG_PATH) -> None:
+    """Writes to a temp file and renames it, so config.json is never half written"""
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as config_json:
         json.dump(config, config_json, indent=1)
+        config_json.flush()
+        os.fsync(config_json.fileno())
+    os.replace(temp_path, path)
 
 
-def add_monthly_tokens(amount: int) -> None:
-    """Adds tokens to this month's tally"""
-    this_month = datetime.utcnow().strftime("%Y-%m")
+_constants = {
+    "OPENAI_KEY": lambda: _keys()["openai_key"],
+    "ELEVENLABS_KEY": lambda: _keys()["elevenlabs_key"],
+    "SYSTEM": _system,
+    "BASE_CONVO": _base_convo,
+    "BASE_LENGTH": lambda: len(_base_convo()),
+    "BASE_SUMMARY": _base_summary,
+    "BAD_WORDS": _bad_words,
+}
+
+
+def __getattr__(name: str):
+    """Reads each constant from its config file the first time it's used"""
+    if name in _constants:
+        return _constants[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class ConfigStore:
+    """
+    config.json kept in memory, with the SET_KEYS lists as frozensets.
+    Changes are validated right away, then written by a background thread once
+    they've stopped coming for save_delay seconds. Edits made to the file
+    while the bot runs are picked up within reload_interval seconds, and an
+    invalid edit is never overwritten, changes wait until it's fixed.
+    """
 
-    with open("config/monthly_tokens.json", "r") as monthly_tokens_json:
-        monthly_tokens: dict = json.load(monthly_tokens_json)
+    def __init__(
+        self,
+        path: str = CONFIG_PATH,
+        save_delay: float = SAVE_DELAY,
+        reload_interval: float = RELOAD_INTERVAL,
+    ):
+        self.path = path
+        self.save_delay = save_delay
+        self.reload_interval = reload_interval
+        self._changed = Condition()
+        # Changes not written yet, replayed on top of the file if it's edited
+        self._pending: list[tuple[str, str, str]] = []
+        self._changed_at = 0.0
+        # The file as it was last read or written, and an invalid edit since
+        self._config, self._mtime = self._read()
+        self._invalid_mtime: int | None = None
+        Thread(target=self._work, name="config", daemon=True).start()
+        atexit.register(self.flush)
 
-    if this_month not in monthly_tokens.keys():
-        monthly_tokens[this_month] = 0
-    monthly_tokens[this_month] += amount
+    def __getitem__(self, key: str):
+        return self._config[key]
 
-    with open("config/monthly_tokens.json", "w") as monthly_tokens_json:
-        json.dump(monthly_tokens, monthly_tokens_json)
+    def get(self, key: str, default=None):
+        return self._config.get(key, default)
 
-    logger.debug(f"Added {amount} to {this_month} in monthly_tokens")
+    def add(self, key: str, value: str) -> None:
+        self._change("add", key, value)
+
+    def discard(self, key: str, value: str) -> None:
+        self._change("discard", key, value)
+
+    def _change(self, op: str, key: str, value: str) -> None:
+        with self._changed:
+            config = self._apply(self._config, [(op, key, value)])
+            if config[key] == self._config[key]:
+                return
+            validate_config(self._dump(config))
+            self._config = config
+            self._pending.append((op, key, value))
+            self._changed_at = monotonic()
+            self._changed.notify()
+
+    @staticmethod
+    def _apply(config: dict, changes: list[tuple[str, str, str]]) -> dict:
+        config = dict(config)
+        for op, key, value in changes:
+            values = set(config[key])
+            getattr(values, op)(value)
+            config[key] = frozenset(values)
+        return config
+
+    @staticmethod
+    def _dump(config: dict) -> dict:
+        return {
+            key: sorted(value, key=str) if key in SET_KEYS else value
+            for key, value in config.items()
+        }
+
+    def _read(self) -> tuple[dict, int]:
+        with open(self.path, "r") as config_json:
+            mtime = os.fstat(config_json.fileno()).st_mtime_ns
+            config = json.load(config_json)
+        validate_config(config)
+        for key in SET_KEYS:
+            config[key] = frozenset(config[key])
+        return config, mtime
+
+    def flush(self) -> bool:
+        """Writes any pending changes now, returns whether there are none left"""
+        with self._changed:
+            if not self._pending:
+                return True
+            # Saving over an edit that wasn't read would throw it away
+            if (mtime := os.stat(self.path).st_mtime_ns) != self._mtime:
+                if mtime != self._invalid_mtime:
+                    logger.error(
+                        f"{self.path} changed since it was read,"
+                        + f" not saving {len(self._pending)} config changes over it"
+                    )
+                return False
+            write_config(self._dump(self._config), self.path)
+            self._mtime = os.stat(self.path).st_mtime_ns
+            logger.info(f"Saved {len(self._pending)} config changes")
+            self._pending.clear()
+            return True
+
+    def _reload(self) -> None:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime in (self._mtime, self._invalid_mtime):
+                return
+            config, mtime = self._read()
+        except OSError as e:
+            logger.warning(f"Couldn't check {self.path} for edits: {e}")
+            return
+        except ValueError as e:
+            # Only reported once, the file is read again when it next changes
+            logger.error(
+                f"Ignored an invalid edit to {self.path}, config changes"
+                + f" won't be saved until it's fixed: {e}"
+            )
+            self._invalid_mtime = mtime
+            return
+        with self._changed:
+            self._config = self._apply(config, self._pending)
+            self._mtime = mtime
+        logger.info(f"Reloaded {self.path} after it was edited")
+
+    def _work(self) -> None:
+        last_reload = monotonic()
+        while True:
+            with self._changed:
+                if self._pending:
+                    timeout = self._changed_at + self.save_delay - monotonic()
+                else:
+                    timeout = last_reload + self.reload_interval - monotonic()
+                if timeout > 0:
+                    self._changed.wait(timeout)
+            saving = self._pending and monotonic() - self._changed_at >= self.save_delay
+            # The file is always checked before saving, so edits to it aren't lost
+            if saving or monotonic() - last_reload >= self.reload_interval:
+                self._reload()
+                last_reload = monotonic()
+            if saving:
+                try:
+                    saved = self.flush()
+                except OSError:
+                    logger.exception(f"Couldn't save {self.path}, retrying")
+                    saved = False
+                if not saved:
+                    self._changed_at = monotonic()
+
+
+@cache
+def token_ledger() -> TokenLedger:
+    """Opens the token ledger the first time it's needed"""
+    return TokenLedger()
+
+
+def add_monthly_tokens(model: str, prompt_tokens: int, completion_tokens: int) -> None:
+    """Adds tokens to this month's tally"""
+    token_ledger().add(model, prompt_tokens, completion_tokens)
+    logger.debug(
+        f"Added {prompt_tokens} prompt and {completion_tokens} completion tokens"
+        + f" for {model} to the ledger"
+    )
 
 
 def read_monthly_tokens() -> int:
     """Reads this month's token tally"""
-    this_month = datetime.utcnow().strftime("%Y-%m")
-    with open("config/monthly_tokens.json", "r") as monthly_tokens_json:
-        monthly_tokens: dict = json.load(monthly_tokens_json)
-    if this_month not in monthly_tokens.keys():
-        add_monthly_tokens(0)
-        return 0
-    current_tokens = monthly_tokens[this_month]
-    logger.debug(f"Read {current_tokens} tokens for {this_month} from monthly_tokens")
-    return current_tokens
+    return token_ledger().month_total()
 
 
 def read_qd_record() -> dict:
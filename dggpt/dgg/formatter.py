@@ -1,18 +1,52 @@
 # Formats responses to make them DGG appropriate
 import re
 import logging
-from emoji import replace_emoji
+from functools import cache
+from emoji import EMOJI_DATA
 from dggpt.request import request_emotes
 
 logger = logging.getLogger(__name__)
 PUNCS = tuple(". , ? ! ' \" > @ # ( ) - * :".split())
 
 
+@cache
+def _emoji_alternation() -> str:
+    emojis = sorted(EMOJI_DATA, key=len, reverse=True)
+    # The lookahead lets most characters skip the long alternation
+    first_chars = "".join(sorted({re.escape(emoji[0]) for emoji in emojis}))
+    alternation = "|".join(re.escape(emoji) for emoji in emojis)
+    # Like emoji.replace_emoji, a joiner is only removed right after an emoji,
+    # and stray variation selectors are always removed
+    return f"(?=[{first_chars}])(?:{alternation})\u200d?|[\ufe0e\ufe0f]"
+
+
+@request_emotes.derive
+def emote_pattern(emotes: tuple) -> re.Pattern:
+    """
+    Returns a pattern for everything format_dgg_message changes:
+    emotes touching punctuation, newlines, and emojis.
+    Rebuilt whenever the emote cache refreshes.
+    """
+    emote_names = "|".join(
+        re.escape(emote) for emote in sorted(emotes, key=len, reverse=True)
+    )
+    puncs = "".join(re.escape(punc) for punc in PUNCS)
+    alternatives = [f"(?P<emoji>{_emoji_alternation()})", "(?P<newline>\n)"]
+    if emote_names:
+        alternatives.append(
+            f"(?P<spaced>(?:{emote_names})(?=[{puncs}])|[{puncs}](?={emote_names}))"
+        )
+    logger.debug(f"Compiling emote pattern for {len(emotes)} emotes")
+    return re.compile("|".join(alternatives))
+
+
+def _replace(match: re.Match) -> str:
+    if match.lastgroup == "spaced":
+        return match.group(0) + " "
+    if match.lastgroup == "newline":
+        return " "
+    return ""
+
+
 def format_dgg_message(message: str, nick: str = None) -> str:
-    for emote in request_emotes():
-        for punc in PUNCS:
-            message = message.replace(f"{emote}{punc}", f"{emote} {punc}")
-            message = message.replace(f"{punc}{emote}", f"{punc} {emote}")
-    message = message.replace("\n", " ")
-    message = replace_emoji(message, replace="")
-    return message
+    return emote_pattern().sub(_replace, message)
@@ -0,0 +1,164 @@
+# Keeps recent DGG chat messages around for the similarity check
+import zlib
+import logging
+from collections import deque
+from itertools import islice
+from random import Random
+from threading import Lock
+from typing import Callable, Iterable, Iterator, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+SHINGLE_SIZE = 5
+BANDS = 20
+ROWS = 4  # slots per band, a pair sharing any whole band is a candidate
+SLOTS = BANDS * ROWS
+_MASK = (1 << 64) - 1
+_SPREAD = 0x9E3779B97F4A7C15
+_rng = Random(1337)
+# The order an empty slot looks through the others for a minhash to borrow
+_BORROW = [
+    _rng.sample([other for other in range(SLOTS) if other != slot], SLOTS - 1)
+    for slot in range(SLOTS)
+]
+# Band keys are saved in the journal, they only stay valid while this does
+KEYS_VERSION = f"oph-crc32-{SHINGLE_SIZE}-{BANDS}x{ROWS}-1337"
+
+
+class HistoryEntry(NamedTuple):
+    message: str
+    normalized: str
+    length: int
+
+
+def normalize(message: str) -> str:
+    return message.lower().strip()
+
+
+def band_keys(normalized: str) -> list[int]:
+    """
+    One permutation MinHash signature of the message's character shingles,
+    split into bands. Every shingle hash lands in one of SLOTS slots, which
+    keeps the smallest hash it gets, and empty slots borrow another slot's.
+    Messages a few percent of edits apart almost always share a band key,
+    ones close to 10% apart only sometimes do, and unrelated ones rarely do.
+    Shingles are hashed with crc32 rather than hash(), so the keys are the
+    same in every process.
+    """
+    signature: list[int | None] = [None] * SLOTS
+    for i in range(max(len(normalized) - SHINGLE_SIZE + 1, 1)):
+        shingle = zlib.crc32(normalized[i : i + SHINGLE_SIZE].encode()) * _SPREAD
+        shingle &= _MASK
+        slot = shingle * SLOTS >> 64
+        if signature[slot] is None or shingle < signature[slot]:
+            signature[slot] = shingle
+    if None in signature:
+        filled = signature.copy()
+        for slot, borrow in enumerate(_BORROW):
+            if signature[slot] is None:
+                lender = next(i for i in borrow if signature[i] is not None)
+                filled[slot] = signature[lender]
+        signature = filled
+    return [
+        hash((band, *signature[band * ROWS : (band + 1) * ROWS]))
+        for band in range(BANDS)
+    ]
+
+
+class ChatHistory:
+    """
+    A window of recent chat messages, normalized once when they're appended.
+    Messages of at least min_length are also kept in an LSH index,
+    so near duplicates can be found without comparing against every message.
+    on_append is called with every message and its band keys once it's added.
+    """
+
+    on_append: Callable[[str, list[int]], None] | None = None
+
+    def __init__(self, maxlen: int, min_length: int = 0):
+        self.min_length = min_length
+        self._entries: deque[tuple[int, HistoryEntry, list[int]]] = deque()
+        self._maxlen = maxlen
+        self._next_id = 0
+        self._buckets: dict[int, set[int]] = {}
+        self._indexed: dict[int, HistoryEntry] = {}
+        self._lock = Lock()
+
+    @property
+    def maxlen(self) -> int:
+        return self._maxlen
+
+    def append(self, message: str) -> None:
+        normalized = normalize(message)
+        entry = HistoryEntry(message, normalized, len(normalized))
+        keys = band_keys(normalized) if entry.length >= self.min_length else []
+        with self._lock:
+            self._add(entry, keys)
+        if self.on_append is not None:
+            self.on_append(message, keys)
+
+    def restore(self, messages: Iterable[tuple[str, list[int] | None]]) -> None:
+        """
+        Adds messages older than any already here, oldest first.
+        Band keys saved by this KEYS_VERSION are reused, None means recompute them.
+        """
+        restored = []
+        for message, keys in messages:
+            normalized = normalize(message)
+            entry = HistoryEntry(message, normalized, len(normalized))
+            if entry.length < self.min_length:
+                keys = []
+            elif not keys:
+                keys = band_keys(normalized)
+            restored.append((entry, keys))
+        with self._lock:
+            newer = [(entry, keys) for _, entry, keys in self._entries]
+            for entry_id, entry, keys in list(self._entries):
+                self._expire(entry_id, entry, keys)
+            self._entries.clear()
+            for entry, keys in (restored + newer)[-self._maxlen :]:
+                self._add(entry, keys)
+
+    def _add(self, entry: HistoryEntry, keys: list[int]) -> None:
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries.append((entry_id, entry, keys))
+        if keys:
+            self._indexed[entry_id] = entry
+            for key in keys:
+                self._buckets.setdefault(key, set()).add(entry_id)
+        while len(self._entries) > self._maxlen:
+            self._expire(*self._entries.popleft())
+
+    def _expire(self, entry_id: int, entry: HistoryEntry, keys: list[int]) -> None:
+        if not keys:
+            return
+        del self._indexed[entry_id]
+        for key in keys:
+            bucket = self._buckets[key]
+            bucket.discard(entry_id)
+            if not bucket:
+                del self._buckets[key]
+
+    def candidates(self, normalized: str, recent: int = 0) -> list[HistoryEntry]:
+        """
+        The newest recent messages, then the older indexed messages
+        that might be near duplicates of normalized
+        """
+        keys = band_keys(normalized)
+        with self._lock:
+            newest = list(islice(reversed(self._entries), recent))
+            ids = set()
+            for key in keys:
+                ids.update(self._buckets.get(key, ()))
+            ids.difference_update(entry_id for entry_id, _, _ in newest)
+            return [entry for _, entry, _ in newest] + [
+                self._indexed[entry_id] for entry_id in ids
+            ]
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            return iter([entry.message for _, entry, _ in self._entries])
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,14 +1,23 @@
 # Handles moderation for messages going out to DGG
 import re
 import logging
-from collections import deque
+from math import ceil, floor
+from typing import Callable
 import Levenshtein
+from dggpt.metrics import filter_rejections
 from dggpt.request import request_phrases
+from .history import ChatHistory, normalize
+from .phrases import PhraseMatcher
 
 logger = logging.getLogger(__name__)
 
 SIMILARITY_MINIMUM_LEN = 85
-SPAM_SEARCH_AMOUNT = 75
+SPAM_SEARCH_AMOUNT = 5000
+# Newest messages always compared exactly, older ones only if the index finds them
+SIMILARITY_EXACT_AMOUNT = 75
+SIMILARITY_THRESHOLD = 0.9
+# Shorter messages can't be similar enough to one of SIMILARITY_MINIMUM_LEN
+SIMILARITY_INDEX_LEN = floor(SIMILARITY_MINIMUM_LEN * SIMILARITY_THRESHOLD)
 
 
 def unique(message: str) -> bool:
@@ -34,21 +43,33 @@ def repeated(message: str) -> bool:
     return False
 
 
+NON_ASCII = re.compile(r"[^\x20-\x7F]")
+ASCII_PUNCT = re.compile(r"[\x21-\x2F\x3A-\x40]")
+
+
 def ascii(message: str) -> bool:
-    non_ascii_count = len(re.findall(r"[^\x20-\x7F]", message))
-    ascii_punct_count = len(re.findall(r"[\x21-\x2F\x3A-\x40]", message))
+    non_ascii_count = len(NON_ASCII.findall(message))
+    ascii_punct_count = len(ASCII_PUNCT.findall(message))
     if non_ascii_count > 20 or ascii_punct_count > 40:
         logger.debug(f'Failed ascii test:\n  "{message}"')
         return True
     return False
 
 
+@request_phrases.derive
+def phrase_matcher(phrases: tuple[tuple[str], tuple[re.Pattern]]) -> PhraseMatcher:
+    """Returns the matcher for the current phrase list"""
+    return PhraseMatcher(*phrases)
+
+
+def matched_phrase(message: str) -> str | None:
+    """Returns the banned phrase that the message contains, if any"""
+    return phrase_matcher().match(message)
+
+
 def bad_word(message: str) -> bool:
-    phrases, regex_phrases = request_phrases()
-    banned_phrase = any(p.lower() in message.lower() for p in phrases)
-    banned_regex = any(r.search(message) for r in regex_phrases)
-    if banned_phrase or banned_regex:
-        logger.debug(f'Failed bad word test:\n  "{message}"')
+    if (phrase := matched_phrase(message)) is not None:
+        logger.debug(f'Failed bad word test ({phrase}):\n  "{message}"')
         return True
     return False
 
@@ -57,31 +78,129 @@ def tags_destiny_with_link(message: str):
     return "https" in message.lower() and "destiny" in message.lower()
 
 
-def too_similar(message: str, message_history: deque[str]) -> bool:
-    def similarity(old_message: str, new_message: str) -> float:
-        longer_message = max(old_message, new_message, key=len)
-        shorter_message = min(old_message, new_message, key=len)
-        longer_length = len(longer_message)
-        if longer_length == 0:
-            return 1.0
-        dist = Levenshtein.distance(longer_message, shorter_message)
-        return (longer_length - dist) / float(longer_length)
-
-    if len(message) < SIMILARITY_MINIMUM_LEN:
+def too_similar(message: str, message_history: ChatHistory) -> bool:
+    new_message = normalize(message)
+    new_length = len(new_message)
+    if new_length < SIMILARITY_MINIMUM_LEN:
         return False
-    for old_message in message_history:
-        if similarity(message.lower().strip(), old_message.lower().strip()) > 0.9:
+    for entry in message_history.candidates(new_message, SIMILARITY_EXACT_AMOUNT):
+        longer_length = max(new_length, entry.length)
+        if longer_length == 0:
+            similarity = 1.0
+        else:
+            # Any distance above this can't pass the threshold
+            cutoff = ceil(longer_length * (1 - SIMILARITY_THRESHOLD))
+            if abs(new_length - entry.length) > cutoff:
+                continue
+            dist = Levenshtein.distance(
+                new_message, entry.normalized, score_cutoff=cutoff
+            )
+            if dist > cutoff:
+                continue
+            similarity = (longer_length - dist) / float(longer_length)
+        if similarity > SIMILARITY_THRESHOLD:
             logger.debug(
                 "Failed similarity test:"
                 + f'\n  Input message: "{message}"'
-                + f'\n  Other message: "{old_message}"'
+                + f'\n  Other message: "{entry.message}"'
             )
             return True
     return False
 
 
-def will_trigger_bot_filter(message: str, message_history: deque[str]) -> bool:
-    return any(
-        check(message)
-        for check in (unique, repeated, ascii, bad_word, tags_destiny_with_link)
-    ) or too_similar(message, message_history)
+def doomed_prefix(message: str) -> bool:
+    """
+    Checks the start of a message for failures that more text can't undo,
+    so that a streamed response can be cancelled early.
+    """
+    if bad_word(message) or tags_destiny_with_link(message) or ascii(message):
+        return True
+    if len(message) >= 90:
+        # Same as repeated, but the last word might still be growing
+        for word in message.split()[:-1]:
+            if len(word) >= 90 / 1.5 and len(set(word)) < 9:
+                return True
+    return False
+
+
+class DoomedCheck:
+    """
+    doomed_prefix for a streamed response, fed the whole text so far each time.
+    Text is formatted and checked a word at a time, so each call only looks at
+    what's new, plus a window as long as the longest banned phrase.
+    Regex phrases longer than that window are left to the full filter.
+    """
+
+    def __init__(
+        self, format_message: Callable[[str], str], bad_words_only: bool = False
+    ):
+        self.format_message = format_message
+        self.bad_words_only = bad_words_only
+        self._done = 0  # raw text up to here has been formatted and checked
+        self._tail = ""  # the end of the formatted text, for phrases spanning words
+        self._length = 0
+        self._non_ascii = 0
+        self._punct = 0
+        self._https = False
+        self._destiny = False
+        self._long_word = False
+
+    def __call__(self, text: str) -> bool:
+        # Formatting never changes anything across a space, so it can be split there
+        if (cut := text.rfind(" ", self._done) + 1) > self._done:
+            segment = self.format_message(text[self._done : cut])
+            self._done = cut
+            if self._check(segment, commit=True):
+                return True
+        # The last word might still be growing, so it's checked but not kept
+        return self._check(self.format_message(text[self._done :]), commit=False)
+
+    def _check(self, segment: str, commit: bool) -> bool:
+        window = self._tail + segment
+        if bad_word(window):
+            return True
+        if self.bad_words_only:
+            if commit:
+                self._tail = window[-phrase_matcher().longest :]
+            return False
+        lowered = window.lower()
+        https = self._https or "https" in lowered
+        destiny = self._destiny or "destiny" in lowered
+        non_ascii = self._non_ascii + len(NON_ASCII.findall(segment))
+        punct = self._punct + len(ASCII_PUNCT.findall(segment))
+        length = self._length + len(segment)
+        words = segment.split() if commit else segment.split()[:-1]
+        long_word = self._long_word or any(
+            len(word) >= 90 / 1.5 and len(set(word)) < 9 for word in words
+        )
+        if https and destiny:
+            return True
+        if non_ascii > 20 or punct > 40:
+            logger.debug(f'Failed ascii test:\n  "{window}"')
+            return True
+        # Same as repeated, once the message is long enough for it to count
+        if length >= 90 and long_word:
+            return True
+        if commit:
+            self._tail = window[-max(phrase_matcher().longest, len("destiny")) :]
+            self._https, self._destiny = https, destiny
+            self._non_ascii, self._punct = non_ascii, punct
+            self._length, self._long_word = length, long_word
+        return False
+
+
+def bot_filter_reason(message: str, message_history: ChatHistory) -> str | None:
+    """Returns the name of the first check that the message fails, if any"""
+    for check in (unique, repeated, ascii, bad_word, tags_destiny_with_link):
+        if check(message):
+            return check.__name__
+    if too_similar(message, message_history):
+        return too_similar.__name__
+    return None
+
+
+def will_trigger_bot_filter(message: str, message_history: ChatHistory) -> bool:
+    if (reason := bot_filter_reason(message, message_history)) is not None:
+        filter_rejections.inc(reason=reason)
+        return True
+    return False
@@ -0,0 +1,90 @@
+# Matches messages against DGG's banned phrase list in a single pass
+import re
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+_BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+
+class PhraseMatcher:
+    """
+    Aho-Corasick automaton for the literal phrases plus a merged regex
+    for the /regex/ phrases, built once per phrase list.
+    """
+
+    def __init__(self, phrases: tuple[str], regex_phrases: tuple[re.Pattern]):
+        self.longest = max(map(len, phrases), default=0)
+        self._build_automaton(phrases)
+        self._build_regexes(regex_phrases)
+        logger.debug(
+            f"Compiled {len(phrases)} phrases and {len(regex_phrases)} regex phrases"
+        )
+
+    def _build_automaton(self, phrases: tuple[str]) -> None:
+        # Each state is a dict of transitions, with a fail link and an output
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[str | None] = [None]
+        for phrase in phrases:
+            state = 0
+            for char in phrase.lower():
+                if (next_state := self._goto[state].get(char)) is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(None)
+                state = next_state
+            if self._output[state] is None:
+                self._output[state] = phrase
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._output[next_state] is None:
+                    self._output[next_state] = self._output[self._fail[next_state]]
+
+    def _build_regexes(self, regex_phrases: tuple[re.Pattern]) -> None:
+        mergeable = [r for r in regex_phrases if not _BACKREFERENCE.search(r.pattern)]
+        self._regexes = [r for r in regex_phrases if r not in mergeable]
+        self._merged = None
+        if mergeable:
+            try:
+                self._merged = re.compile(
+                    "|".join(f"(?:{r.pattern})" for r in mergeable), re.IGNORECASE
+                )
+                self._mergeable = mergeable
+            except re.error:
+                logger.warning("Couldn't merge regex phrases, matching separately")
+                self._regexes = list(regex_phrases)
+
+    def match(self, message: str) -> str | None:
+        """Returns the first banned phrase found in the message, if any"""
+        if self._output[0] is not None:
+            return self._output[0]
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for char in message.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] is not None:
+                return output[state]
+        if self._merged is not None and self._merged.search(message):
+            # Only runs on a hit, to find out which regex it was
+            for regex in self._mergeable:
+                if regex.search(message):
+                    return f"/{regex.pattern}/"
+            return f"/{self._merged.pattern}/"
+        for regex in self._regexes:
+            if regex.search(message):
+                return f"/{regex.pattern}/"
+        return None
@@ -1,26 +1,33 @@
 import logging
-from threading import Thread
-from collections import deque, Counter
+from threading import Thread, Lock
 from random import choice
 from datetime import datetime, timedelta
-from time import sleep
+from time import perf_counter, monotonic
+from concurrent.futures import ThreadPoolExecutor
 from dggbot import DGGBot, DGGLive, Message, StreamInfo
 from .config import (
     BASE_CONVO,
     BASE_SUMMARY,
-    read_config,
-    save_config,
-    read_qd_record,
-    write_qd_record,
+    ConfigStore,
 )
 from .gpt import generate_response, generate_summary, generate_solution, generate_image
-from .gpt.convo import delete_last_prompt, trim_tokens
+from .gpt.convo import Convo, delete_last_prompt, trim_tokens
+from .gpt.memory import Memory
 from .gpt.tokens import get_cost_from_tokens, count_tokens
-from .gpt.moderation import flag_check
-from .tts import generate_tts
-from .tts.formatter import format_tts_message
+from .gpt.moderation import flag_check, moderation_cache
 from .dgg import format_dgg_message, will_trigger_bot_filter
-from .dgg.moderation import bad_word, SPAM_SEARCH_AMOUNT
+from .dgg.history import ChatHistory
+from .dgg.moderation import (
+    bad_word,
+    DoomedCheck,
+    SIMILARITY_INDEX_LEN,
+    SPAM_SEARCH_AMOUNT,
+)
+from .games import GameEngine, Quickdraw, SimonSays
+from .jobs import JobQueue
+from .journal import Journal
+from .outbox import Outbox, Outgoing, Priority
+from .metrics import registry, response_checks
 from .request import (
     request_debate,
     request_emotes,
@@ -34,47 +41,76 @@ logger = logging.getLogger(__name__)
 class DGGPTBot(DGGBot):
     """Base form of the bot with no commands"""
 
-    def __init__(self):
+    def __init__(self, **kwargs):
+        """kwargs are passed on to DGGBot, e.g. a config with other endpoints"""
         # gpt_config keys: "dgg_key", "openai_key", "admins", "blacklist"
-        self.gpt_config = read_config()
-        super().__init__(self.gpt_config["dgg_key"])
+        self.gpt_config = ConfigStore()
+        super().__init__(self.gpt_config["dgg_key"], **kwargs)
         self._avoid_dupe = True
         self.stream_is_live: bool = False
         self.tts_mode: bool = False
+        self.speculative_mode: bool = False
+        self.stream_mode: bool = False
+        self.memory_mode: bool = False
         self.last_sent: datetime = datetime.now() - timedelta(seconds=60)
-        self.convo: list[dict] = list(BASE_CONVO)
-        self.summaries: list[dict] = list(BASE_SUMMARY)
-        self.message_history: deque[str] = deque(maxlen=SPAM_SEARCH_AMOUNT)
+        self.base_convo = Convo(BASE_CONVO)
+        self.memory = Memory()
+        self.message_history = ChatHistory(
+            maxlen=SPAM_SEARCH_AMOUNT, min_length=SIMILARITY_INDEX_LEN
+        )
+        self.journal = Journal()
+        self.restore()
+        self.jobs = JobQueue()
+        self.outbox = Outbox()
+        self.convo_lock = Lock()
+        self.summary_lock = Lock()
+        self.speculation_pool = ThreadPoolExecutor(thread_name_prefix="speculative")
         self.cooldown = 30
         self.max_tokens = 2500
         self.max_resp_tokens = 80
-        self.simonsays = {
-            "emote": None,
-            "winners": [],
-            "time_started": datetime.now(),
-        }
-        self.quickdraw = {
-            "waiting": False,
-            "time_started": datetime.now(),
-            "record": read_qd_record(),
-        }
+        self.games = GameEngine()
         Thread(target=self.update_live_status).start()
         logger.info(f"Bot initialized, prompt tokens: {count_tokens(self.convo)}")
 
-    def send(self, data: str):
-        logger.debug(f"Sending message:\n{data}")
-        if len(data) < 512:
-            super().send(data)
+    def restore(self):
+        """Picks up the convos and chat history from the journal, then tracks them"""
+        state = self.journal.load()
+        convo = state.convos.get("convo", [])
+        base_length = len(self.base_convo)
+        # Memory mode starts off, so the memory from last time is dropped
+        if len(convo) > base_length and convo[base_length]["role"] == "system":
+            del convo[base_length]
+        if convo[:base_length] == self.base_convo:
+            self.convo = self.base_convo.copy()
+            self.convo.extend(convo[base_length:])
         else:
-            for substring in [data[i : i + 512] for i in range(0, len(data), 512)]:
-                super().send(substring)
-                sleep(2)
+            self.convo = self.base_convo.copy()
+        summaries = state.convos.get("summaries", [])
+        if summaries[: len(BASE_SUMMARY)] != list(BASE_SUMMARY):
+            summaries = BASE_SUMMARY
+        self.summaries = Convo(summaries)
+        self.message_history.restore(state.history)
+        self.journal.track("convo", self.convo)
+        self.journal.track("summaries", self.summaries)
+        self.message_history.on_append = self.journal.chat
+        self.journal.start()
+
+    def send(self, data: str, priority: Priority = Priority.RESPONSE) -> Outgoing:
+        """Queues a message in the outbox, split into 512 character chunks"""
+        logger.debug(f"Queueing message:\n{data}")
+        chunks = [(data[i : i + 512],) for i in range(0, max(len(data), 1), 512)]
+        return self.outbox.put_chunks(super().send, chunks, priority=priority)
+
+    def send_privmsg(
+        self, nick: str, data: str, priority: Priority = Priority.RESPONSE
+    ) -> Outgoing:
+        return self.outbox.put(super().send_privmsg, nick, data, priority=priority)
 
     def _convert_to_int(self, value):
         try:
             return int(value)
         except ValueError as e:
-            self.send("that's not an integer MMMM")
+            self.send("that's not an integer MMMM", Priority.ADMIN)
             raise e
 
     def check_cooldown(self) -> int:
@@ -85,19 +121,22 @@ class DGGPTBot(DGGBot):
     def is_admin(self, msg: Message) -> bool:
         return msg.nick in self.gpt_config["admins"]
 
+    def is_owner(self, nick: str) -> bool:
+        return nick in self.gpt_config["admins"] and nick in ("tena", "Destiny")
+
     def process_privmsg(self, nick: str, data: str):
         logger.info(f"Got whispered: {nick}: {data}")
         if nick in self.gpt_config["admins"]:
             self.respond_to_mention(nick, data)
-            sleep(3)
+            # Queued behind the response, so it arrives after it
             self.send_privmsg(nick, "PepOk")
 
-    def process_msg(self, nick: str, data: str):
+    def process_msg(self, nick: str, data: str, received: float = None):
+        """received is the monotonic time the message came in"""
+        if received is None:
+            received = monotonic()
         self.message_history.append(data)
-        if self.quickdraw["waiting"] and (data == "YEEHAW" or data == "PARDNER"):
-            self.end_quickdraw(nick, data)
-        if self.simonsays["emote"] and data == self.simonsays["emote"]:
-            self.end_simonsays(nick)
+        self.games.dispatch(nick, data, received)
 
     def respond_with_flags(self, nick: str, data: str):
         if flags := flag_check(data, raise_error=False):
@@ -114,42 +153,48 @@ class DGGPTBot(DGGBot):
         self.last_sent = datetime.now()
         return flags
 
-    def pre_response_check(self, nick: str, data: str) -> bool:
+    def pre_response_check(self, nick: str, data: str, moderate: bool = True) -> bool:
+        reason = self.failed_response_check(nick, data, moderate)
+        response_checks.inc(result=reason or "pass")
+        return reason is None
+
+    def failed_response_check(self, nick: str, data: str, moderate: bool) -> str | None:
+        """Returns the reason a mention shouldn't be responded to, if any"""
         if data.startswith(self.prefix):
             logger.debug("Check fail: Name and command used at the same time")
-            return False
+            return "command"
         if self.convo[-1]["role"] == "user":
             logger.warning("Check fail: Still waiting on the last completion")
-            return False
+            return "waiting"
         if "#kick/gpt71" in data:
             logger.debug(f"Check fail: Name used in Kick embed")
-            return False
+            return "kick_embed"
         if nick in self.gpt_config["admins"]:
-            if nick == "tena" or nick == "Destiny":
+            if self.is_owner(nick):
                 logger.debug("Check pass: Owner requested")
-                return True
+                return None
             if self.check_cooldown() and self.tts_mode:
                 logger.debug(f"Check fail: Admin prompt on cooldown during tts mode")
-                return False
-            if self.respond_with_flags(nick, data):
+                return "cooldown"
+            if moderate and self.respond_with_flags(nick, data):
                 logger.debug(f"Check fail: Admin prompt was flagged")
-                return False
+                return "flagged"
             logger.debug("Check pass: Admin requested")
-            return True
+            return None
         if self.stream_is_live:
             logger.debug("Check fail: Stream is live")
-            return False
+            return "stream_live"
         if remaining := self.check_cooldown():
             logger.debug(f"Check fail: On cooldown for another {remaining}s")
-            return False
+            return "cooldown"
         if nick in self.gpt_config["blacklist"]:
             logger.debug(f"Check fail: {nick} is blacklisted")
-            return False
-        if self.respond_with_flags(nick, data):
+            return "blacklisted"
+        if moderate and self.respond_with_flags(nick, data):
             logger.debug(f"Check fail: Prompt was flagged")
-            return False
+            return "flagged"
         logger.debug("Check pass")
-        return True
+        return None
 
     def send_filter_response(self, user: str):
         responses = (
@@ -163,12 +208,31 @@ class DGGPTBot(DGGBot):
 
     def respond_to_mention(self, nick: str, data: str):
         logger.debug(f"Bot was mentioned:\n  {nick}: {data}")
-        if not self.pre_response_check(nick, data):
+        if not self.convo_lock.acquire(blocking=False):
+            logger.warning("Check fail: Still waiting on the last completion")
+            response_checks.inc(result="waiting")
+            return
+        try:
+            self._respond_to_mention(nick, data)
+        finally:
+            self.convo_lock.release()
+
+    def _respond_to_mention(self, nick: str, data: str):
+        speculate = self.speculative_mode and not self.is_owner(nick)
+        if not self.pre_response_check(nick, data, moderate=not speculate):
             return
         self.last_sent = datetime.now()
-        self.convo = trim_tokens(self.convo, self.max_tokens)
-        generate_response(nick, data, self.convo, self.max_resp_tokens)
+        self.trim_convo()
+        if speculate:
+            if not self.speculative_response(nick, data):
+                return
+        else:
+            self.generate(nick, data, self.convo)
+        if self.stream_cancelled(nick):
+            return
         if self.tts_mode:
+            from .tts import generate_tts, format_tts_message
+
             resp = self.convo[-1]["content"]
             if nick.lower() not in resp:
                 formatted = f"{nick}, {resp}"
@@ -189,12 +253,77 @@ class DGGPTBot(DGGBot):
                 return
             self.send(formatted)
 
+    def speculative_response(self, nick: str, data: str) -> bool:
+        """
+        Moderates the prompt while its completion is already running.
+        The completion is only added to the convo if the prompt wasn't flagged.
+        """
+
+        def timed(func, *args):
+            start = perf_counter()
+            return func(*args), perf_counter() - start
+
+        start = perf_counter()
+        flags_future = self.speculation_pool.submit(
+            timed, self.respond_with_flags, nick, data
+        )
+        draft, completion_time = timed(self.generate, nick, data, self.convo.copy())
+        flags, moderation_time = flags_future.result()
+        saved = moderation_time + completion_time - (perf_counter() - start)
+        if flags:
+            response_checks.inc(result="flagged")
+            logger.info(f"Discarded speculative completion, overlap saved {saved:.2f}s")
+            return False
+        logger.info(f"Speculative completion kept, overlap saved {saved:.2f}s")
+        self.convo.extend(draft[len(self.convo) :])
+        return True
+
+    def trim_convo(self):
+        """Trims the convo, folding old turns into the memory when it's on"""
+        if self.memory_mode:
+            self.convo = self.memory.trim(self.convo, self.max_tokens)
+        else:
+            self.convo = trim_tokens(self.convo, self.max_tokens)
+
+    def generate(self, nick: str, data: str, convo: list[dict]) -> list[dict]:
+        """Gets a response to a prompt, streaming it when stream mode is on"""
+        doomed = self.doomed_check() if self.stream_mode else None
+        return generate_response(nick, data, convo, self.max_resp_tokens, doomed)
+
+    def doomed_check(self) -> DoomedCheck:
+        """A fresh check for one streamed response"""
+        if self.tts_mode:
+            from .tts import format_tts_message
+
+            return DoomedCheck(format_tts_message, bad_words_only=True)
+        return DoomedCheck(format_dgg_message)
+
+    def stream_cancelled(self, nick: str) -> bool:
+        """Cleans up after a streamed response that was cancelled early"""
+        if self.convo[-1]["role"] != "user":
+            return False
+        logger.debug("Streamed response was cancelled by the filter")
+        del self.convo[-1]
+        self.send_filter_response(nick)
+        return True
+
     def respond_to_log(self, nick: str):
         logger.debug("!respond was called")
         log_info = request_latest_log(nick)
+        if not self.convo_lock.acquire(blocking=False):
+            logger.warning("Still waiting on the last completion")
+            return
+        try:
+            self._respond_to_log(nick, log_info)
+        finally:
+            self.convo_lock.release()
+
+    def _respond_to_log(self, nick: str, log_info: dict):
         self.last_sent = datetime.now()
-        self.convo = trim_tokens(self.convo, self.max_tokens)
-        generate_response(nick, log_info["text"], self.convo, self.max_resp_tokens)
+        self.trim_convo()
+        self.generate(nick, log_info["text"], self.convo)
+        if self.stream_cancelled(nick):
+            return
         formatted = format_dgg_message(self.convo[-1]["content"], nick)
         if nick.lower() not in formatted.lower():
             formatted = f"{nick} {formatted}"
@@ -206,7 +335,7 @@ class DGGPTBot(DGGBot):
         self.send(formatted)
 
     def repeat(self, data: str):
-        self.send(data.split(maxsplit=1)[1])
+        self.send(data.split(maxsplit=1)[1], Priority.ADMIN)
         self.last_sent = datetime.now()
 
     def send_cost(self):
@@ -218,136 +347,124 @@ class DGGPTBot(DGGBot):
     def send_summary(self, user1: str, user2: str, amount: str | int):
         logger.debug(f"!summarize was used on {user1} & {user2}")
         self.last_sent = datetime.now()
-        self.summaries = list(BASE_SUMMARY)
         debate = request_debate(user1, user2, amount)
         if isinstance(debate, str):
             self.send(debate)
             return
-        generate_summary("\n".join(debate), self.summaries)
-        self.send(self.summaries[-1]["content"])
+        with self.summary_lock:
+            self.summaries = Convo(BASE_SUMMARY)
+            self.journal.track("summaries", self.summaries)
+            generate_summary("\n".join(debate), self.summaries)
+            self.send(self.summaries[-1]["content"])
 
     def send_solution(self):
         logger.debug("!solve was called")
-        if self.summaries == list(BASE_SUMMARY):
-            self.send("I don't have a summary stored MMMM")
-            return
-        generate_solution(self.summaries)
-        self.last_sent = datetime.now()
-        self.send(self.summaries[-1]["content"])
-        self.summaries = list(BASE_SUMMARY)
+        with self.summary_lock:
+            if self.summaries == list(BASE_SUMMARY):
+                self.send("I don't have a summary stored MMMM")
+                return
+            generate_solution(self.summaries)
+            self.last_sent = datetime.now()
+            self.send(self.summaries[-1]["content"])
+            self.summaries = Convo(BASE_SUMMARY)
+            self.journal.track("summaries", self.summaries)
 
     def clear_caches(self):
         logger.debug("!clearcache was called")
-        request_phrases.cache_clear()
-        request_emotes.cache_clear()
-        self.send("PepOk cleared caches")
+        request_phrases.refresh()
+        request_emotes.refresh()
+        moderation_cache.clear()
+        self.send("PepOk cleared caches", Priority.ADMIN)
 
     def clear_convo(self):
-        self.convo = list(BASE_CONVO)
+        with self.convo_lock:
+            self.convo = self.base_convo.copy()
+            self.journal.track("convo", self.convo)
+            self.memory.reset()
         logger.debug(f"Convo wiped, tokens at {count_tokens(self.convo)}")
 
     def clear_last_prompt(self):
         logger.debug("!wipelast was called")
-        delete_last_prompt(self.convo)
-        self.send(f"PepOk deleted the last prompt")
+        with self.convo_lock:
+            delete_last_prompt(self.convo)
+        self.send(f"PepOk deleted the last prompt", Priority.ADMIN)
 
     def blacklist_add(self, name: str):
         logger.info(f"!bla was used on {name}")
-        if name not in self.gpt_config["blacklist"]:
-            self.gpt_config["blacklist"].append(name)
-        save_config(self.gpt_config)
-        self.send(f"PepOk {name} blacklisted")
+        self.gpt_config.add("blacklist", name)
+        self.send(f"PepOk {name} blacklisted", Priority.ADMIN)
 
     def blacklist_remove(self, name: str):
         logger.info(f"!blr was used on {name}")
-        if name in self.gpt_config["blacklist"]:
-            self.gpt_config["blacklist"].remove(name)
-        save_config(self.gpt_config)
-        self.send(f"PepOk {name} unblacklisted")
+        self.gpt_config.discard("blacklist", name)
+        self.send(f"PepOk {name} unblacklisted", Priority.ADMIN)
 
     def change_cooldown(self, seconds: str):
         self.cooldown = self._convert_to_int(seconds)
         logger.info(f"cooldown set to {seconds}")
-        self.send(f"PepOk changed the cooldown to {self.cooldown}s")
+        self.send(f"PepOk changed the cooldown to {self.cooldown}s", Priority.ADMIN)
 
     def change_token_limit(self, limit: str):
         logger.debug("!maxtokens was used")
         limit = self._convert_to_int(limit)
-        base_tokens = count_tokens(list(BASE_CONVO))
+        base_tokens = count_tokens(self.base_convo)
         if limit > 3996 or limit < base_tokens:
-            self.send(f"token limit must be between {base_tokens} and 3996 MMMM")
+            self.send(
+                f"token limit must be between {base_tokens} and 3996 MMMM",
+                Priority.ADMIN,
+            )
             return
         self.max_tokens = limit
-        self.send(f"PepOk changed the max tokens to {self.max_tokens}")
+        self.send(f"PepOk changed the max tokens to {self.max_tokens}", Priority.ADMIN)
 
     def change_resp_token_limit(self, limit: str):
         logger.debug("!maxresp was used")
         limit = self._convert_to_int(limit)
         if limit < 1:
-            self.send(f"must be positive MMMM")
+            self.send(f"must be positive MMMM", Priority.ADMIN)
             return
         self.max_resp_tokens = limit
-        self.send(f"PepOk changed the max response length to {self.max_resp_tokens}")
+        self.send(
+            f"PepOk changed the max response length to {self.max_resp_tokens}",
+            Priority.ADMIN,
+        )
 
     def toggle_tts_mode(self):
+        if not self.tts_mode:
+            # elevenlabs only gets imported once TTS mode is used
+            from . import tts
         self.tts_mode = not self.tts_mode
         word = "enabled" if self.tts_mode else "disabled"
         logger.info(f"TTS mode was {word}")
-        self.send(f"PepOk TTS mode {word}")
+        self.send(f"PepOk TTS mode {word}", Priority.ADMIN)
+
+    def toggle_speculative_mode(self):
+        self.speculative_mode = not self.speculative_mode
+        word = "enabled" if self.speculative_mode else "disabled"
+        logger.info(f"Speculative mode was {word}")
+        self.send(f"PepOk speculative mode {word}", Priority.ADMIN)
+
+    def toggle_memory_mode(self):
+        with self.convo_lock:
+            self.memory_mode = not self.memory_mode
+            if not self.memory_mode:
+                self.memory.uninstall(self.convo)
+                self.memory.reset()
+        word = "enabled" if self.memory_mode else "disabled"
+        logger.info(f"Memory mode was {word}")
+        self.send(f"PepOk memory mode {word}", Priority.ADMIN)
+
+    def toggle_stream_mode(self):
+        self.stream_mode = not self.stream_mode
+        word = "enabled" if self.stream_mode else "disabled"
+        logger.info(f"Stream mode was {word}")
+        self.send(f"PepOk stream mode {word}", Priority.ADMIN)
 
     def start_quickdraw(self):
-        logger.debug("Starting quickdraw")
-        self.send("> QUICKDRAW! PARDNER vs YEEHAW")
-        self.quickdraw["waiting"] = True
-        self.quickdraw["time_started"] = datetime.now()
-        return
-
-    def end_quickdraw(self, nick: str, data: str):
-        logger.debug(f"Quickdraw ended by {nick}")
-        self.quickdraw["waiting"] = False
-        delta = datetime.now() - self.quickdraw["time_started"]
-        response_time = round(delta.total_seconds(), 2)
-        ending_message = (
-            f"{data} {nick} shot first! Response time: {response_time} seconds. "
-        )
-        if response_time < self.quickdraw["record"]["time"]:
-            ending_message += "New record!"
-            self.quickdraw["record"]["time"] = response_time
-            self.quickdraw["record"]["holder"] = nick
-            write_qd_record(self.quickdraw["record"])
-        else:
-            ending_message += f'Record time: {self.quickdraw["record"]["time"]} by {self.quickdraw["record"]["holder"]}'
-        self.send(ending_message)
-
-    def simonsays_thread(self):
-        emotes = request_emotes()
-        i = 0
-        while i < 4:
-            self.simonsays["emote"] = choice(emotes)
-            self.send(f"> Simon says... {self.simonsays['emote']}")
-            self.simonsays["time_started"] = datetime.now()
-            self.last_sent = datetime.now()
-            while self.simonsays["emote"] != None:
-                sleep(0.5)
-            i += 1
-            sleep(5)
-        winners = Counter(self.simonsays["winners"]).most_common()
-        winners_list = [f"{name}: {count}" for name, count in winners]
-        self.send("Final scores Klappa " + ", ".join(winners_list))
-        self.simonsays["winners"] = []
+        self.games.start(Quickdraw(self))
 
     def start_simonsays(self):
-        logger.debug("Starting simon says")
-        Thread(target=self.simonsays_thread).start()
-
-    def end_simonsays(self, nick: str):
-        logger.debug(f"Simon says ended by {nick}")
-        delta = datetime.now() - self.simonsays["time_started"]
-        response_time = round(delta.total_seconds() * 1000)
-        self.send(f"{nick} got it in {response_time} ms Klappa")
-        self.last_sent = datetime.now()
-        self.simonsays["emote"] = None
-        self.simonsays["winners"].append(nick)
+        self.games.start(SimonSays(self))
 
     def spam_check(self, nick: str, data: str):
         if will_trigger_bot_filter(data, self.message_history):
@@ -355,6 +472,30 @@ class DGGPTBot(DGGBot):
         else:
             self.send_privmsg(nick, "This is safe to post MMMM")
 
+    def send_job_stats(self):
+        stats = self.jobs.stats()
+        outbox = self.outbox.stats()
+        self.send(
+            f"PepOk {stats['depth']} queued, {stats['dropped']} dropped,"
+            + f" {stats['failed']} failed, wait avg {stats['avg_wait']:.2f}s"
+            + f" max {stats['max_wait']:.2f}s, outbox {outbox['depth']} queued"
+            + f" {outbox['dropped']} dropped",
+            Priority.ADMIN,
+        )
+        if self.memory_mode:
+            memory = self.memory.stats()
+            self.send(
+                f"PepOk memory {memory['tokens']} tokens after"
+                + f" {memory['compactions']} compactions, saved {memory['saved']}"
+                + f" prompt tokens for {memory['spent']} spent compacting",
+                Priority.ADMIN,
+            )
+
+    def send_metrics(self):
+        self.send(
+            registry.summary() or "No latencies recorded yet MMMM", Priority.ADMIN
+        )
+
     def send_coinflip(self):
         self.send(f"You got {choice(['heads', 'tails'])}")
 
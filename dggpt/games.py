@@ -0,0 +1,175 @@
+# Chat minigames, driven by the messages that chat sends in
+import logging
+from abc import ABC, abstractmethod
+from collections import Counter
+from datetime import datetime
+from random import choice
+from threading import Condition, Lock, Thread
+from time import sleep
+from typing import TYPE_CHECKING
+from .config import read_qd_record, write_qd_record
+from .outbox import Priority
+from .request import request_emotes
+
+if TYPE_CHECKING:
+    from .dggpt import DGGPTBot
+
+logger = logging.getLogger(__name__)
+
+
+class Game(ABC):
+    """
+    A minigame that runs on its own thread.
+    Chat messages are handed to on_message along with the monotonic time
+    they were received, and run waits on self.event for them to arrive,
+    for at most TIMEOUT seconds before giving up on chat.
+    """
+
+    TIMEOUT = 60
+
+    def __init__(self, bot: "DGGPTBot"):
+        self.bot = bot
+        self.event = Condition()
+
+    @abstractmethod
+    def run(self) -> None: ...
+
+    @abstractmethod
+    def on_message(self, nick: str, data: str, received: float) -> None: ...
+
+
+class GameEngine:
+    """Runs any number of games at once and feeds them chat messages"""
+
+    def __init__(self):
+        self._games: list[Game] = []
+        self._lock = Lock()
+
+    def start(self, game: Game) -> None:
+        with self._lock:
+            self._games.append(game)
+        Thread(target=self._run, args=(game,), daemon=True).start()
+
+    def _run(self, game: Game) -> None:
+        try:
+            game.run()
+        except Exception:
+            logger.exception(f"{type(game).__name__} crashed")
+        finally:
+            with self._lock:
+                self._games.remove(game)
+
+    def dispatch(self, nick: str, data: str, received: float) -> None:
+        with self._lock:
+            games = self._games[:]
+        for game in games:
+            game.on_message(nick, data, received)
+
+
+class Quickdraw(Game):
+    WORDS = ("YEEHAW", "PARDNER")
+    _record_lock = Lock()
+
+    def __init__(self, bot: "DGGPTBot"):
+        super().__init__(bot)
+        self.time_started: float | None = None
+        self.winner: tuple[str, str, float] | None = None
+
+    def on_message(self, nick: str, data: str, received: float) -> None:
+        if data not in self.WORDS:
+            return
+        with self.event:
+            if self.time_started is None or self.winner is not None:
+                return
+            if received >= self.time_started:
+                self.winner = (nick, data, received)
+                self.event.notify()
+
+    def run(self) -> None:
+        logger.debug("Starting quickdraw")
+        sent_at = self.bot.send("> QUICKDRAW! PARDNER vs YEEHAW", Priority.GAME).wait()
+        if sent_at is None:
+            logger.warning("Quickdraw prompt was dropped, ending the game")
+            return
+        with self.event:
+            self.time_started = sent_at
+            if not self.event.wait_for(lambda: self.winner is not None, self.TIMEOUT):
+                logger.debug("Quickdraw timed out")
+                self.bot.send(
+                    "Nobody drew in time, quickdraw is over MMMM", Priority.GAME
+                )
+                return
+        nick, data, received = self.winner
+        logger.debug(f"Quickdraw ended by {nick}")
+        response_time = round(received - self.time_started, 2)
+        ending_message = (
+            f"{data} {nick} shot first! Response time: {response_time} seconds. "
+        )
+        with self._record_lock:
+            record = read_qd_record()
+            if response_time < record["time"]:
+                ending_message += "New record!"
+                record["time"] = response_time
+                record["holder"] = nick
+                write_qd_record(record)
+            else:
+                ending_message += f'Record time: {record["time"]} by {record["holder"]}'
+        self.bot.send(ending_message, Priority.GAME)
+
+
+class SimonSays(Game):
+    ROUNDS = 4
+    ROUND_DELAY = 5
+
+    def __init__(self, bot: "DGGPTBot"):
+        super().__init__(bot)
+        self.emote: str | None = None
+        self.time_started = 0.0
+        self.winner: tuple[str, float] | None = None
+
+    def on_message(self, nick: str, data: str, received: float) -> None:
+        with self.event:
+            if self.emote is None or data != self.emote:
+                return
+            if self.winner is None and received >= self.time_started:
+                self.winner = (nick, received)
+                self.event.notify()
+
+    def run(self) -> None:
+        logger.debug("Starting simon says")
+        emotes = request_emotes()
+        winners = []
+        for _ in range(self.ROUNDS):
+            emote = choice(emotes)
+            sent_at = self.bot.send(f"> Simon says... {emote}", Priority.GAME).wait()
+            if sent_at is None:
+                logger.warning("Simon says prompt was dropped, ending the game")
+                return
+            with self.event:
+                self.emote = emote
+                self.winner = None
+                self.time_started = sent_at
+                self.bot.last_sent = datetime.now()
+                answered = self.event.wait_for(
+                    lambda: self.winner is not None, self.TIMEOUT
+                )
+                self.emote = None
+            if not answered:
+                logger.debug("Simon says timed out")
+                self.bot.send(
+                    "Nobody got it in time, simon says is over MMMM", Priority.GAME
+                )
+                break
+            nick, received = self.winner
+            logger.debug(f"Simon says round won by {nick}")
+            response_time = round((received - self.time_started) * 1000)
+            self.bot.send(f"{nick} got it in {response_time} ms Klappa", Priority.GAME)
+            self.bot.last_sent = datetime.now()
+            winners.append(nick)
+            sleep(self.ROUND_DELAY)
+        if not winners:
+            return
+        winners_list = [
+            f"{name}: {count}" for name, count in Counter(winners).most_common()
+        ]
+        self.bot.send("Final scores Klappa " + ", ".join(winners_list), Priority.GAME)
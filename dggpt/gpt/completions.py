@@ -1,5 +1,8 @@
 # Handles all requests to openai
 import logging
+from functools import cache
+from time import perf_counter
+from typing import Callable
 from openai import OpenAI
 from openai import (
     OpenAI,
@@ -33,9 +36,9 @@ openai_errors = (
     UnprocessableEntityError,
     APIResponseValidationError,
 )
-from dggpt.config import OPENAI_KEY, add_monthly_tokens
-
-client = OpenAI(api_key=OPENAI_KEY, timeout=20, max_retries=0)
+from dggpt import config
+from dggpt.config import add_monthly_tokens
+from dggpt.metrics import api_latency, chat_ttft, stream_cancellations
 
 logger = logging.getLogger(__name__)
 
@@ -43,6 +46,13 @@ CHAT_MODEL = "gpt-5-nano"
 IMAGE_MODEL = "dall-e-3"
 
 
+@cache
+def get_client() -> OpenAI:
+    """Creates the openai client the first time it's needed"""
+    return OpenAI(api_key=config.OPENAI_KEY, timeout=20, max_retries=0)
+
+
+@api_latency.timed(endpoint="moderation")
 def moderation_completion(message: str) -> list[str]:
     """
     Gets a moderation completion from openai.
@@ -50,7 +60,7 @@ def moderation_completion(message: str) -> list[str]:
     """
     flags = []
     logger.debug("Sending moderation request...")
-    mod = client.moderations.create(input=message)
+    mod = get_client().moderations.create(input=message)
     for category in mod.results[0].categories:
         if category[1]:
             flags.append(category[0])
@@ -65,6 +75,7 @@ def moderation_completion(message: str) -> list[str]:
     return flags
 
 
+@api_latency.timed(endpoint="chat")
 def chat_completion(convo: list[dict], max_tokens: int = 65) -> list[dict]:
     """
     Gets a chat completion from openai.
@@ -73,7 +84,7 @@ def chat_completion(convo: list[dict], max_tokens: int = 65) -> list[dict]:
 
     logger.debug(f"Sending chat request...\n  Input: {convo[-1]}")
     try:
-        rsp = client.chat.completions.create(
+        rsp = get_client().chat.completions.create(
             model=CHAT_MODEL,
             max_tokens=max_tokens,
             messages=convo,
@@ -87,10 +98,72 @@ def chat_completion(convo: list[dict], max_tokens: int = 65) -> list[dict]:
     message = dict(rsp.choices[0].message)
     convo.append({"role": "assistant", "content": message["content"]})
     logger.debug(f"Chat completion recieved\n  Output: {message}")
-    add_monthly_tokens(rsp.usage.total_tokens)
+    add_monthly_tokens(CHAT_MODEL, rsp.usage.prompt_tokens, rsp.usage.completion_tokens)
+    return convo
+
+
+@api_latency.timed(endpoint="chat_stream")
+def chat_completion_stream(
+    convo: list[dict],
+    max_tokens: int = 65,
+    doomed: Callable[[str], bool] | None = None,
+) -> list[dict]:
+    """
+    Streams a chat completion from openai.
+    Each time text arrives, doomed(text so far) is called. If it returns True
+    the stream is cancelled and nothing is appended to the convo.
+    Takes in an openai convo, returns the updated convo.
+    """
+
+    logger.debug(f"Sending streamed chat request...\n  Input: {convo[-1]}")
+    start = perf_counter()
+    parts, usage, cancelled = [], None, False
+    try:
+        stream = get_client().chat.completions.create(
+            model=CHAT_MODEL,
+            max_tokens=max_tokens,
+            messages=convo,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        with stream:
+            for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices or not (delta := chunk.choices[0].delta.content):
+                    continue
+                if not parts:
+                    chat_ttft.observe(ttft := perf_counter() - start)
+                    logger.debug(f"Time to first token: {ttft:.3f}s")
+                parts.append(delta)
+                if doomed is not None and doomed("".join(parts)):
+                    cancelled = True
+                    break
+    except openai_errors as openai_error:
+        error_name = type(openai_error).__name__
+        error_message = f"error: {error_name} temmieDank"
+        logger.warning(f"Got an openai error: {openai_error}")
+        convo.append({"role": "assistant", "content": error_message})
+        return convo
+    content = "".join(parts)
+    if cancelled:
+        from .tokens import count_tokens, get_encoding
+
+        stream_cancellations.inc()
+        logger.info(f"Cancelled a doomed completion:\n  Output so far: {content}")
+        # Usage only comes with the last chunk, so estimate what was spent
+        add_monthly_tokens(
+            CHAT_MODEL, count_tokens(convo), len(get_encoding().encode(content))
+        )
+        return convo
+    convo.append({"role": "assistant", "content": content})
+    logger.debug(f"Streamed chat completion recieved\n  Output: {content}")
+    if usage is not None:
+        add_monthly_tokens(CHAT_MODEL, usage.prompt_tokens, usage.completion_tokens)
     return convo
 
 
+@api_latency.timed(endpoint="image")
 def image_completion(prompt: str) -> str:
     """
     Gets an image from openai.
@@ -98,7 +171,7 @@ def image_completion(prompt: str) -> str:
     """
 
     logger.debug(f"Sending image request...\n  Input: {prompt}")
-    rsp = client.images.generate(
+    rsp = get_client().images.generate(
         model=IMAGE_MODEL,
         prompt=prompt,
         size="1024x1024",
@@ -1,19 +1,161 @@
 # Various tools for manipulating openai convos
 import logging
-from dggpt.config import BASE_LENGTH
-from .tokens import count_tokens
+from typing import Callable, Iterable
+from dggpt import config
+from .tokens import count_message_tokens
 
 logger = logging.getLogger(__name__)
 
 
-def trim_tokens(convo: list[dict], max_tokens: int) -> list[dict]:
-    """Trims old messages from a convo"""
-    old_convo = convo[:]
-    while count_tokens(convo) > max_tokens:
-        logger.debug(f"Trimming from convo: {convo[BASE_LENGTH : BASE_LENGTH + 2]}")
-        del convo[BASE_LENGTH : BASE_LENGTH + 2]
-    if (new_tokens := count_tokens(convo)) != (old_tokens := count_tokens(old_convo)):
+class Convo(list):
+    """
+    An openai convo that remembers the token count of each message.
+    Counts are taken once when a message is added, so reading the total is O(1).
+    on_change is called after every change as on_change(start, stop, messages),
+    meaning convo[start:stop] was replaced by messages. Copies don't inherit it.
+    """
+
+    on_change: Callable[[int, int, list[dict]], None] | None = None
+
+    def __init__(self, messages: Iterable[dict] = ()):
+        super().__init__(messages)
+        self._message_tokens = [count_message_tokens(message) for message in self]
+        self._total = sum(self._message_tokens)
+
+    @property
+    def tokens(self) -> int:
+        """Token count of the whole convo, including the reply primer"""
+        return self._total + 2
+
+    def copy(self) -> "Convo":
+        """Copies the convo without recounting any tokens"""
+        new_convo = Convo.__new__(Convo)
+        list.__init__(new_convo, self)
+        new_convo._message_tokens = self._message_tokens[:]
+        new_convo._total = self._total
+        return new_convo
+
+    def _changed(self, start: int, stop: int, messages: list[dict]) -> None:
+        if self.on_change is not None:
+            self.on_change(start, stop, messages)
+
+    def _range(self, index) -> tuple[int, int] | None:
+        """The range index covers, or None if it isn't contiguous"""
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            return (start, max(start, stop)) if step == 1 else None
+        index = index + len(self) if index < 0 else index
+        return index, index + 1
+
+    def append(self, message: dict) -> None:
+        super().append(message)
+        message_tokens = count_message_tokens(message)
+        self._message_tokens.append(message_tokens)
+        self._total += message_tokens
+        self._changed(len(self) - 1, len(self) - 1, [message])
+
+    def extend(self, messages: Iterable[dict]) -> None:
+        for message in messages:
+            self.append(message)
+
+    def __iadd__(self, messages: Iterable[dict]) -> "Convo":
+        self.extend(messages)
+        return self
+
+    def insert(self, index: int, message: dict) -> None:
+        index = min(max(index + len(self) if index < 0 else index, 0), len(self))
+        super().insert(index, message)
+        message_tokens = count_message_tokens(message)
+        self._message_tokens.insert(index, message_tokens)
+        self._total += message_tokens
+        self._changed(index, index, [message])
+
+    def __setitem__(self, index, value) -> None:
+        length, changed = len(self), self._range(index)
+        if isinstance(index, slice):
+            value = list(value)
+            new_tokens = [count_message_tokens(message) for message in value]
+        else:
+            new_tokens = count_message_tokens(value)
+        super().__setitem__(index, value)
+        self._total -= self._sum(self._message_tokens[index])
+        self._message_tokens[index] = new_tokens
+        self._total += self._sum(new_tokens)
+        if changed is None:
+            self._changed(0, length, list(self))
+        else:
+            self._changed(*changed, value if isinstance(value, list) else [value])
+
+    def __delitem__(self, index) -> None:
+        length, changed = len(self), self._range(index)
+        super().__delitem__(index)
+        self._total -= self._sum(self._message_tokens[index])
+        del self._message_tokens[index]
+        self._changed(*(changed or (0, length)), [] if changed else list(self))
+
+    def pop(self, index: int = -1) -> dict:
+        changed = self._range(index)
+        message = super().pop(index)
+        self._total -= self._message_tokens.pop(index)
+        self._changed(*changed, [])
+        return message
+
+    def remove(self, message: dict) -> None:
+        del self[self.index(message)]
+
+    def clear(self) -> None:
+        length = len(self)
+        super().clear()
+        self._message_tokens.clear()
+        self._total = 0
+        self._changed(0, length, [])
+
+    def sort(self, *, key=None, reverse: bool = False) -> None:
+        super().sort(key=key, reverse=reverse)
+        self._message_tokens = [count_message_tokens(message) for message in self]
+        self._changed(0, len(self), list(self))
+
+    def reverse(self) -> None:
+        super().reverse()
+        self._message_tokens.reverse()
+        self._changed(0, len(self), list(self))
+
+    def __imul__(self, times: int) -> "Convo":
+        length = len(self)
+        super().__imul__(times)
+        self._message_tokens *= times
+        self._total = sum(self._message_tokens)
+        self._changed(0, length, list(self))
+        return self
+
+    @staticmethod
+    def _sum(tokens: int | list[int]) -> int:
+        return tokens if isinstance(tokens, int) else sum(tokens)
+
+
+def trim_tokens(
+    convo: list[dict],
+    max_tokens: int,
+    keep: int | None = None,
+    on_trim: Callable[[list[dict]], None] | None = None,
+) -> Convo:
+    """
+    Trims old messages from a convo, never touching the first keep messages
+    (the base convo by default). on_trim is called with everything trimmed.
+    """
+    if not isinstance(convo, Convo):
+        convo = Convo(convo)
+    base_length = config.BASE_LENGTH if keep is None else keep
+    old_tokens = convo.tokens
+    trimmed = []
+    while convo.tokens > max_tokens and len(convo) > base_length:
+        logger.debug(f"Trimming from convo: {convo[base_length : base_length + 2]}")
+        trimmed.extend(convo[base_length : base_length + 2])
+        del convo[base_length : base_length + 2]
+    if (new_tokens := convo.tokens) != old_tokens:
         logger.debug(f"Trimmed prompt from {old_tokens} to {new_tokens} tokens")
+    if trimmed and on_trim is not None:
+        on_trim(trimmed)
     return convo
 
 
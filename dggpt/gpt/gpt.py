@@ -1,8 +1,9 @@
 # Ties together all of the gpt tools
 import logging
-from dggbot import Message
-from .completions import chat_completion, image_completion
+from typing import Callable
+from .completions import chat_completion, chat_completion_stream, image_completion
 from .moderation import flag_check, remove_bad_words
+from .summary import summarize
 
 logger = logging.getLogger(__name__)
 
@@ -15,28 +16,31 @@ def generate_response(
     data: str,
     convo: list[dict],
     max_tokens: int,
+    doomed: Callable[[str], bool] | None = None,
 ) -> list[dict]:
     """
     Gets a chat completion from openai for a DGG message
     Takes in an openai convo, returns the new openai convo
+    If doomed is given, the response is streamed and cancelled once doomed
+    returns True for it, leaving the prompt as the last message
     Warning: Does not moderate the input or response!
     """
     logger.debug("Getting chat response...")
     convo.append(user_message(nick, data))
+    if doomed is not None:
+        return chat_completion_stream(convo, max_tokens, doomed)
     return chat_completion(convo, max_tokens)
 
 
 def generate_summary(debate: str, convo: list[dict]) -> list[dict]:
     """
     Moderates a DGG debate and then gets a summary completion from openai
+    Long debates are summarized in token budgeted chunks and then combined
     Takes in an openai convo, returns the new openai convo
     Warning: Does not moderate the response!
     """
     logger.debug("Getting summary...")
-    debate = remove_bad_words(debate)
-    flag_check(debate)
-    convo.append(summary_message(debate))
-    return chat_completion(convo, max_tokens=100)
+    return summarize(remove_bad_words(debate), convo)
 
 
 def generate_solution(convo: list[dict]) -> list[dict]:
@@ -0,0 +1,212 @@
+# Folds turns trimmed from the convo into a short rolling memory
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from dggpt import config
+from dggpt.metrics import memory_tokens
+from .completions import chat_completion
+from .convo import Convo, trim_tokens
+from .summary import is_error
+from .tokens import count_message_tokens, count_tokens, get_encoding
+
+logger = logging.getLogger(__name__)
+
+WINDOW_TOKENS = 1200  # recent turns kept word for word, on top of the base convo
+MEMORY_TOKENS = 150  # the memory is shortened again once it grows past this
+COMPACT_TOKENS = 200  # most tokens a compaction can answer with
+PENDING_TURNS = 50  # turns kept for a retry after failed compactions, oldest go first
+MEMORY_PROMPT = (
+    "You keep the memory of a chat bot in a busy live stream chat."
+    + " Rewrite the memory so it also covers the new messages, keeping names,"
+    + " running jokes and anything the bot was asked to remember."
+    + " Use at most 100 words. Respond with the memory only."
+)
+SHORTEN_PROMPT = (
+    "Shorten this memory to half its length, keeping the most important names"
+    + " and facts. Respond with the memory only."
+)
+
+
+def format_turns(turns: list[dict]) -> str:
+    return "\n".join(
+        f"{turn.get('name', 'bot' if turn['role'] == 'assistant' else 'chat')}:"
+        + f" {turn['content']}"
+        for turn in turns
+    )
+
+
+class Memory:
+    """
+    A short summary of the turns trimmed from a convo.
+    Trimmed turns are folded into it by a background thread, so requests
+    never wait on it. Turns that fail to fold in are retried with the next
+    ones, up to PENDING_TURNS. The latest summary sits right after the base
+    convo as a system message, while only WINDOW_TOKENS of recent turns are kept.
+    """
+
+    def __init__(
+        self, window_tokens: int = WINDOW_TOKENS, max_tokens: int = MEMORY_TOKENS
+    ):
+        self.window_tokens = window_tokens
+        self.max_tokens = max_tokens
+        self.summary = ""
+        self.compactions = 0
+        self.saved = 0
+        self.spent = 0
+        self._trimmed_tokens = 0  # turns trimmed since the last reset and not lost
+        self._base_tokens: int | None = None
+        self._message: dict | None = None
+        self._message_summary = ""
+        self._message_tokens = 0
+        self._pending: list[dict] = []
+        self._busy = False
+        self._generation = 0
+        self._lock = Lock()
+        self._pool = ThreadPoolExecutor(1, thread_name_prefix="memory")
+
+    def _installed(self, convo: list[dict]) -> bool:
+        base_length = config.BASE_LENGTH
+        return (
+            self._message is not None
+            and len(convo) > base_length
+            and convo[base_length] is self._message
+        )
+
+    def install(self, convo: list[dict]) -> Convo:
+        """Puts the latest memory after the base convo, replacing the old one"""
+        if not isinstance(convo, Convo):
+            convo = Convo(convo)
+        with self._lock:
+            summary = self.summary
+        if not summary:
+            return convo
+        if self._installed(convo):
+            if self._message_summary == summary:
+                return convo
+            del convo[config.BASE_LENGTH]
+        self._message_summary = summary
+        self._message = {
+            "role": "system",
+            "content": f"What you remember from earlier in chat: {summary}",
+        }
+        self._message_tokens = count_message_tokens(self._message)
+        convo.insert(config.BASE_LENGTH, self._message)
+        return convo
+
+    def uninstall(self, convo: list[dict]) -> list[dict]:
+        if self._installed(convo):
+            del convo[config.BASE_LENGTH]
+        return convo
+
+    def trim(self, convo: list[dict], max_tokens: int) -> Convo:
+        """
+        Trims the convo down to the window, folding what's trimmed into the memory.
+        Records how many prompt tokens this saved against trimming to max_tokens.
+        """
+        convo = self.install(convo)
+        installed = self._installed(convo)
+        keep = config.BASE_LENGTH + installed
+        if self._base_tokens is None:
+            self._base_tokens = count_tokens(config.BASE_CONVO)
+        kept_tokens = self._base_tokens + installed * self._message_tokens
+        limit = min(max_tokens, kept_tokens + self.window_tokens)
+        convo = trim_tokens(convo, limit, keep, self.evict)
+        without_memory = convo.tokens + self._trimmed_tokens
+        if installed:
+            without_memory -= self._message_tokens
+        if (saved := min(max_tokens, without_memory) - convo.tokens) > 0:
+            self.saved += saved
+            memory_tokens.inc(saved, kind="saved")
+        return convo
+
+    def evict(self, turns: list[dict]) -> None:
+        """Queues trimmed turns to be folded into the memory"""
+        with self._lock:
+            self._pending.extend(turns)
+            self._trimmed_tokens += sum(count_message_tokens(turn) for turn in turns)
+            if self._busy:
+                return
+            self._busy = True
+        self._pool.submit(self._work)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.summary = ""
+            self._pending.clear()
+            self._trimmed_tokens = 0
+            self._generation += 1
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "tokens": len(get_encoding().encode(self.summary)),
+                "compactions": self.compactions,
+                "pending": len(self._pending),
+                "saved": self.saved,
+                "spent": self.spent,
+            }
+
+    def _work(self) -> None:
+        while True:
+            with self._lock:
+                turns, self._pending = self._pending, []
+                summary, generation = self.summary, self._generation
+                if not turns:
+                    self._busy = False
+                    return
+            try:
+                new_summary = self.compact(summary, turns)
+            except Exception:
+                logger.exception("Couldn't compact the memory")
+                new_summary = None
+            with self._lock:
+                if generation != self._generation:
+                    continue
+                if new_summary is None:
+                    # Retried along with the next turns that are trimmed
+                    self._retry(turns)
+                    self._busy = False
+                    return
+                self.summary = new_summary
+                self.compactions += 1
+
+    def _retry(self, turns: list[dict]) -> None:
+        """Puts turns back in front of the pending ones, dropping the oldest"""
+        self._pending[:0] = turns
+        if (excess := len(self._pending) - PENDING_TURNS) > 0:
+            lost, self._pending = self._pending[:excess], self._pending[excess:]
+            self._trimmed_tokens -= sum(count_message_tokens(turn) for turn in lost)
+            logger.warning(f"Memory compaction keeps failing, lost {excess} turns")
+
+    def compact(self, summary: str, turns: list[dict]) -> str | None:
+        """
+        Returns the memory rewritten to cover turns, shortened if it grew,
+        or None if it couldn't be rewritten
+        """
+        prompt = (
+            f"Memory so far: {summary or 'nothing yet'}\n"
+            + f"New messages:\n{format_turns(turns)}"
+        )
+        if (new_summary := self._complete(MEMORY_PROMPT, prompt)) is None:
+            logger.warning(f"Memory compaction failed, retrying {len(turns)} turns")
+            return None
+        if len(get_encoding().encode(new_summary)) > self.max_tokens:
+            logger.debug("Memory grew too long, shortening it")
+            new_summary = self._complete(SHORTEN_PROMPT, new_summary) or new_summary
+        logger.info(f"Folded {len(turns)} turns into memory: {new_summary}")
+        return new_summary
+
+    def _complete(self, system: str, prompt: str) -> str | None:
+        convo = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": prompt},
+        ]
+        spent = count_tokens(convo)
+        content = chat_completion(convo, COMPACT_TOKENS)[-1]["content"]
+        if is_error(content):
+            return None
+        spent += len(get_encoding().encode(content))
+        with self._lock:
+            self.spent += spent
+        memory_tokens.inc(spent, kind="spent")
+        return content.strip()
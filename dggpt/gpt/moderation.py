@@ -1,27 +1,55 @@
 # Handles moderation for prompts to openai
 import re
 import logging
-from dggpt.config import BAD_WORDS
+from collections import Counter
+from functools import cache
+from dggpt import config
+from dggpt.cache import TTLCache
 from .completions import moderation_completion
 
 logger = logging.getLogger(__name__)
 
-bad_patterns = [re.compile(rf"\b{bad_word}\b", re.IGNORECASE) for bad_word in BAD_WORDS]
+
+moderation_cache = TTLCache(maxsize=1024, ttl=6 * 60 * 60)
 
 
 def flag_check(message: str, raise_error: bool = True) -> list:
     """Get all flags triggered by a prompt and raise an error"""
-    if (flags := moderation_completion(message)) and raise_error:
+    key = " ".join(message.lower().split())
+    if (flags := moderation_cache.get(key)) is None:
+        flags = tuple(moderation_completion(message))
+        moderation_cache.set(key, flags)
+    else:
+        logger.debug(f"Moderation cache hit: {moderation_cache.stats()}")
+    if flags and raise_error:
         raise Exception(f"Prompt was flagged")
-    return flags
+    return list(flags)
+
+
+@cache
+def bad_pattern() -> re.Pattern:
+    """Compiles every bad word into one pattern the first time it's needed"""
+    bad_words = "|".join(config.BAD_WORDS) or "(?!)"
+    return re.compile(rf"\b(?:{bad_words})\b", re.IGNORECASE)
+
+
+def scrub_bad_words(message: str) -> tuple[str, Counter]:
+    """
+    Replaces all bad words (defined in bad_words.csv) in a string with "_".
+    Returns the new string and how many times each bad word was hit.
+    """
+    hits = Counter()
+
+    def replace(match: re.Match) -> str:
+        hits[match.group(0).lower()] += 1
+        return "_"
+
+    message = bad_pattern().sub(replace, message)
+    if hits:
+        logger.debug(f"Removed bad words from the message: {dict(hits)}")
+    return message, hits
 
 
 def remove_bad_words(message: str) -> str:
     """Removes all bad words (defined in bad_words.csv) from a string."""
-    old_message = message
-    for bad_pattern in bad_patterns:
-        if bad_pattern.search(message):
-            message = bad_pattern.sub("_", message)
-    if old_message != message:
-        logger.debug(f"Removed bad words from the message")
-    return message
+    return scrub_bad_words(message)[0]
@@ -0,0 +1,152 @@
+# Summarizes debates too long for one prompt by summarizing parts of them at once
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from dggpt.metrics import summary_stage_latency, summary_tokens
+from .completions import chat_completion
+from .moderation import flag_check
+from .tokens import count_tokens, get_encoding
+
+logger = logging.getLogger(__name__)
+
+CHUNK_TOKENS = 1500  # most debate tokens sent in one summary request
+SUMMARY_TOKENS = 100
+MAP_WORKERS = 4
+REDUCE_PROMPT = (
+    "These are summaries of consecutive parts of one conversation, oldest first."
+    + " Combine them into a single summary."
+)
+
+summary_pool = ThreadPoolExecutor(MAP_WORKERS, thread_name_prefix="summary")
+
+
+def chunk_lines(
+    lines: list[str], budget: int = CHUNK_TOKENS, overhead: int = 0
+) -> list[list[str]]:
+    """
+    Packs lines in order into chunks of at most budget tokens,
+    counting overhead more tokens for whatever each line is prefixed with.
+    A line longer than the whole budget is cut short.
+    """
+    encoding = get_encoding()
+    limit = budget - overhead
+    chunks, chunk, used = [], [], 0
+    for line in lines:
+        tokens = encoding.encode(line)
+        if len(tokens) > limit:
+            line, tokens = encoding.decode(tokens[:limit]), tokens[:limit]
+        # +1 for the newline joining it to the rest of the chunk
+        cost = len(tokens) + overhead + 1
+        if chunk and used + cost > budget:
+            chunks.append(chunk)
+            chunk, used = [], 0
+        chunk.append(line)
+        used += cost
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def is_error(content: str) -> bool:
+    return content.startswith("error: ")
+
+
+def without_errors(results: list[str], what: str) -> list[str]:
+    """Drops the completions that failed, logging how many did"""
+    if failed := sum(map(is_error, results)):
+        logger.warning(f"{failed} of {len(results)} {what} failed to summarize")
+    return [result for result in results if not is_error(result)]
+
+
+def _complete(convo: list[dict], moderate: bool) -> tuple[str, int]:
+    """Returns the completion and roughly how many tokens it cost"""
+    if moderate:
+        flag_check(convo[-1]["content"])
+    prompt_tokens = count_tokens(convo)
+    content = chat_completion(convo, SUMMARY_TOKENS)[-1]["content"]
+    return content, prompt_tokens + len(get_encoding().encode(content))
+
+
+def run_stage(
+    stage: str, base: list[dict], prompts: list[str], moderate: bool = False
+) -> list[str]:
+    """
+    Completes every prompt on its own copy of the base convo, all at once.
+    Logs and records the wall time and tokens the stage took.
+    """
+    start = perf_counter()
+    results = list(
+        summary_pool.map(
+            lambda prompt: _complete(
+                base + [{"role": "user", "content": prompt}], moderate
+            ),
+            prompts,
+        )
+    )
+    elapsed = perf_counter() - start
+    tokens = sum(spent for _, spent in results)
+    summary_stage_latency.observe(elapsed, stage=stage)
+    summary_tokens.inc(tokens, stage=stage)
+    logger.info(
+        f"Summary {stage}: {len(prompts)} requests, ~{tokens} tokens, {elapsed:.2f}s"
+    )
+    return [content for content, _ in results]
+
+
+def reduce_prompt(partials: list[str]) -> str:
+    parts = "\n".join(f"Part {i}: {partial}" for i, partial in enumerate(partials, 1))
+    return f"{REDUCE_PROMPT}\n{parts}"
+
+
+def summarize(debate: str, convo: list[dict], budget: int = CHUNK_TOKENS) -> list[dict]:
+    """
+    Summarizes a debate that's already had its bad words removed.
+    Short debates are sent as they are. Longer ones are split into chunks
+    of at most budget tokens which are summarized at once (map), then the
+    partial summaries are combined into one (reduce), in rounds if needed.
+    Takes in an openai convo, returns it with the prompt and summary appended.
+    """
+    start = perf_counter()
+    base = list(convo)
+    chunks = chunk_lines(debate.splitlines(), budget)
+    if len(chunks) == 1:
+        prompt = "\n".join(chunks[0])
+        flag_check(prompt)
+        content = run_stage("single", base, [prompt])[0]
+        convo.append({"role": "user", "content": prompt})
+        convo.append({"role": "assistant", "content": content})
+        return convo
+
+    partials = run_stage("map", base, ["\n".join(c) for c in chunks], moderate=True)
+    if not (summaries := without_errors(partials, "parts")):
+        convo.append({"role": "assistant", "content": partials[0]})
+        return convo
+
+    # Only happens when there are more partial summaries than fit in one prompt
+    encoding = get_encoding()
+    budget -= len(encoding.encode(REDUCE_PROMPT)) + 1
+    # Every summary is prefixed with its part number, the last one's is longest
+    overhead = len(encoding.encode(f"Part {len(summaries)}: "))
+    while len(groups := chunk_lines(summaries, budget, overhead)) > 1:
+        if len(groups) == len(summaries):
+            # Combining them one at a time wouldn't shorten anything
+            logger.warning("Partial summaries don't fit together, truncating them")
+            limit = max(budget // len(summaries) - overhead - 1, 1)
+            summaries = [
+                encoding.decode(encoding.encode(summary)[:limit])
+                for summary in summaries
+            ]
+            break
+        combined = run_stage("combine", base, [reduce_prompt(g) for g in groups])
+        if not (summaries := without_errors(combined, "combined parts")):
+            convo.append({"role": "assistant", "content": combined[0]})
+            return convo
+        overhead = len(encoding.encode(f"Part {len(summaries)}: "))
+    prompt = reduce_prompt(summaries)
+    content = run_stage("reduce", base, [prompt])[0]
+    convo.append({"role": "user", "content": prompt})
+    convo.append({"role": "assistant", "content": content})
+    logger.info(
+        f"Summarized {len(chunks)} chunks in {perf_counter() - start:.2f}s total"
+    )
+    return convo
@@ -1,27 +1,47 @@
 # Calculates various things from openai tokens
+import os
 import logging
+from functools import cache
 import tiktoken
 from dggpt.config import read_monthly_tokens
 from .completions import CHAT_MODEL
 
 logger = logging.getLogger(__name__)
 
-encoding = tiktoken.encoding_for_model(CHAT_MODEL)
+# Keeps downloaded BPE files in the config volume so restarts work offline
+TOKENIZER_CACHE = "config/tiktoken"
+FALLBACK_ENCODING = "o200k_base"
+
+
+@cache
+def get_encoding() -> tiktoken.Encoding:
+    """Loads the tokenizer the first time it's needed"""
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", TOKENIZER_CACHE)
+    try:
+        return tiktoken.encoding_for_model(CHAT_MODEL)
+    except KeyError:
+        logger.debug(f"tiktoken doesn't know {CHAT_MODEL}, using {FALLBACK_ENCODING}")
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+
+
+def count_message_tokens(message: dict) -> int:
+    """Count the amount of tokens a single message adds to an openai convo"""
+    encoding = get_encoding()
+    num_tokens = 4
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":
+            num_tokens += -1
+    return num_tokens
 
 
 def count_tokens(convo: list[dict]) -> int:
     """Count the amount of tokens present in an openai convo"""
-    num_tokens = 0
-    for message in convo:
-        num_tokens += 4
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += -1
-    num_tokens += 2
-    return num_tokens
+    if (tokens := getattr(convo, "tokens", None)) is not None:
+        return tokens
+    return sum(count_message_tokens(message) for message in convo) + 2
 
 
 def get_cost_from_tokens() -> int:
-    """Read the token tally from monthly_tokens.json and return it in dollars"""
+    """Read the token tally from the ledger and return it in dollars"""
     return round(read_monthly_tokens() / 1000000 * 0.156, 2)
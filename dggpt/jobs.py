@@ -0,0 +1,87 @@
+# Runs slow bot work (openai, elevenlabs, rustlesearch) off the chat event thread
+import logging
+from collections import deque
+from queue import Queue, Full
+from threading import Thread, Lock
+from time import monotonic
+from typing import Callable, NamedTuple
+from .metrics import job_wait, jobs_dropped
+
+logger = logging.getLogger(__name__)
+
+WORKERS = 2
+QUEUE_SIZE = 16
+
+
+class Job(NamedTuple):
+    func: Callable
+    args: tuple
+    kwargs: dict
+    queued_at: float
+
+
+class JobQueue:
+    """A bounded job queue served by a fixed pool of worker threads"""
+
+    def __init__(self, workers: int = WORKERS, maxsize: int = QUEUE_SIZE):
+        self._queue: Queue[Job] = Queue(maxsize)
+        self._lock = Lock()
+        self._wait_times: deque[float] = deque(maxlen=200)
+        self.submitted = 0
+        self.dropped = 0
+        self.failed = 0
+        for i in range(workers):
+            Thread(target=self._work, name=f"job-worker-{i}", daemon=True).start()
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def pending(self) -> int:
+        """Jobs that are queued or still running"""
+        return self._queue.unfinished_tasks
+
+    def submit(self, func: Callable, *args, **kwargs) -> bool:
+        """Queues a function call, returns False if the queue was full"""
+        try:
+            self._queue.put_nowait(Job(func, args, kwargs, monotonic()))
+        except Full:
+            with self._lock:
+                self.dropped += 1
+            jobs_dropped.inc(queue="jobs")
+            logger.warning(f"Job queue full, dropped {func.__name__}")
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def stats(self) -> dict[str, int | float]:
+        """Returns the queue depth, job counts and wait times in seconds"""
+        with self._lock:
+            wait_times = list(self._wait_times)
+            return {
+                "depth": self.depth,
+                "submitted": self.submitted,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "avg_wait": sum(wait_times) / len(wait_times) if wait_times else 0.0,
+                "max_wait": max(wait_times, default=0.0),
+            }
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            wait_time = monotonic() - job.queued_at
+            with self._lock:
+                self._wait_times.append(wait_time)
+            job_wait.observe(wait_time, queue="jobs")
+            logger.debug(f"Running {job.func.__name__} after {wait_time:.3f}s in queue")
+            try:
+                job.func(*job.args, **job.kwargs)
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                logger.exception(f"Job {job.func.__name__} failed")
+            finally:
+                self._queue.task_done()
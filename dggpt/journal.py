@@ -0,0 +1,180 @@
+# Journals the convos and chat history to disk, so a restart picks up where it left off
+import os
+import json
+import atexit
+import logging
+from collections import deque
+from queue import SimpleQueue
+from threading import Thread
+from time import perf_counter
+from typing import NamedTuple
+from .dgg.history import KEYS_VERSION
+from .dgg.moderation import SPAM_SEARCH_AMOUNT
+from .gpt.convo import Convo
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_DIR = "config/journal"
+COMPACT_EVERY = 10000  # records written between snapshots
+
+
+class JournalState(NamedTuple):
+    convos: dict[str, list[dict]]
+    # Chat messages oldest first, with their band keys or None if they're stale
+    history: list[tuple[str, list[int] | None]]
+
+
+def apply(convos: dict[str, list[dict]], history: deque, record: list) -> None:
+    """Applies a journal record to the state it describes"""
+    kind = record[0]
+    if kind == "track":
+        convos[record[1]] = list(record[2])
+    elif kind == "splice":
+        _, name, start, stop, messages = record
+        convos[name][start:stop] = messages
+    elif kind == "chat":
+        history.append((record[1], record[2]))
+
+
+class Journal:
+    """
+    An append-only log of every change to the tracked convos and chat history.
+    Changes are queued where they happen and written by a background thread,
+    which keeps its own copy of the state. Every COMPACT_EVERY records that
+    copy is written to a snapshot and the journal starts over.
+    """
+
+    def __init__(
+        self,
+        path: str = JOURNAL_DIR,
+        history_len: int = SPAM_SEARCH_AMOUNT,
+        compact_every: int = COMPACT_EVERY,
+    ):
+        self.compact_every = compact_every
+        self._journal_path = os.path.join(path, "journal.jsonl")
+        self._snapshot_path = os.path.join(path, "snapshot.json")
+        os.makedirs(path, exist_ok=True)
+        self._queue: SimpleQueue[list | None] = SimpleQueue()
+        self._convos: dict[str, list[dict]] = {}
+        self._history: deque = deque(maxlen=history_len)
+        self._seq = 0
+        self._since_snapshot = 0
+        self._file = None
+        self._thread = Thread(target=self._work, name="journal", daemon=True)
+
+    def load(self) -> JournalState:
+        """Replays the journal on top of the last snapshot"""
+        start = perf_counter()
+        keys_valid = False
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path, "r") as snapshot_json:
+                snapshot: dict = json.load(snapshot_json)
+            self._seq = snapshot["seq"]
+            self._convos = snapshot["convos"]
+            self._history.extend(map(tuple, snapshot["history"]))
+            keys_valid = snapshot["keys"] == KEYS_VERSION
+        replayed = 0
+        if os.path.exists(self._journal_path):
+            with open(self._journal_path, "r") as journal_jsonl:
+                for line in journal_jsonl:
+                    try:
+                        seq, *record = json.loads(line)
+                    except ValueError:
+                        # Only the last line can be cut short, by a crash mid write
+                        logger.warning(
+                            "Skipped a broken line at the end of the journal"
+                        )
+                        break
+                    # Left over from a crash between a snapshot and truncating
+                    if seq <= self._seq:
+                        continue
+                    apply(self._convos, self._history, record)
+                    self._seq = seq
+                    replayed += 1
+        if not keys_valid:
+            for i, (message, _) in enumerate(self._history):
+                self._history[i] = (message, None)
+        history = list(self._history)
+        logger.info(
+            f"Loaded {len(self._convos)} convos and {len(history)} chat messages,"
+            + f" replayed {replayed} records in {perf_counter() - start:.3f}s"
+        )
+        return JournalState(
+            {name: list(messages) for name, messages in self._convos.items()}, history
+        )
+
+    def start(self) -> None:
+        """Starts writing, beginning with a fresh snapshot of the loaded state"""
+        self._thread.start()
+        atexit.register(self.close)
+
+    def track(self, name: str, convo: Convo) -> None:
+        """Journals every change to convo as name, replacing anything tracked before"""
+        self._queue.put(["track", name, list(convo)])
+        convo.on_change = lambda start, stop, messages: self._queue.put(
+            ["splice", name, start, stop, messages]
+        )
+
+    def chat(self, message: str, keys: list[int]) -> None:
+        self._queue.put(["chat", message, keys])
+
+    def close(self) -> None:
+        """Writes everything queued so far, then stops"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+    def _work(self) -> None:
+        try:
+            self._compact()
+        except OSError:
+            logger.exception("Couldn't snapshot the journal, it's disabled")
+            return
+        closing = False
+        while not closing:
+            records = [self._queue.get()]
+            while not self._queue.empty():
+                records.append(self._queue.get())
+            if None in records:
+                closing = True
+                records = records[: records.index(None)]
+            try:
+                self._write(records)
+            except OSError:
+                logger.exception("Couldn't write to the journal")
+        self._file.close()
+
+    def _write(self, records: list[list]) -> None:
+        lines = []
+        for record in records:
+            apply(self._convos, self._history, record)
+            self._seq += 1
+            lines.append(json.dumps([self._seq, *record]) + "\n")
+        self._file.writelines(lines)
+        self._file.flush()
+        self._since_snapshot += len(lines)
+        if self._since_snapshot >= self.compact_every:
+            self._compact()
+
+    def _compact(self) -> None:
+        """Snapshots the state, then starts the journal over"""
+        start = perf_counter()
+        temp_path = self._snapshot_path + ".tmp"
+        with open(temp_path, "w") as snapshot_json:
+            json.dump(
+                {
+                    "seq": self._seq,
+                    "keys": KEYS_VERSION,
+                    "convos": self._convos,
+                    "history": list(self._history),
+                },
+                snapshot_json,
+            )
+            snapshot_json.flush()
+            os.fsync(snapshot_json.fileno())
+        os.replace(temp_path, self._snapshot_path)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self._journal_path, "w")
+        self._since_snapshot = 0
+        logger.debug(f"Journal compacted in {perf_counter() - start:.3f}s")
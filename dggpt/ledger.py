@@ -0,0 +1,100 @@
+# Keeps the monthly token tally in an append-only sqlite ledger
+import os
+import json
+import sqlite3
+import logging
+from datetime import datetime
+from threading import Lock
+from time import time
+
+logger = logging.getLogger(__name__)
+
+LEDGER_PATH = "config/tokens.db"
+LEGACY_PATH = "config/monthly_tokens.json"
+
+
+def this_month() -> str:
+    return datetime.utcnow().strftime("%Y-%m")
+
+
+class TokenLedger:
+    """
+    Appends token usage to a sqlite database in WAL mode.
+    This month's totals are kept in memory, and every completion is committed
+    as it's added, so nothing is lost when the bot is killed.
+    """
+
+    def __init__(self, path: str = LEDGER_PATH):
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "ts REAL, month TEXT, model TEXT,"
+                " prompt_tokens INTEGER, completion_tokens INTEGER)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS usage_month ON usage (month)"
+            )
+        self._import_legacy()
+        self._load_month(this_month())
+
+    def _import_legacy(self) -> None:
+        """Copies the old monthly_tokens.json tally into an empty ledger"""
+        if not os.path.exists(LEGACY_PATH):
+            return
+        if self._conn.execute("SELECT 1 FROM usage LIMIT 1").fetchone():
+            return
+        with open(LEGACY_PATH, "r") as monthly_tokens_json:
+            monthly_tokens: dict = json.load(monthly_tokens_json)
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO usage VALUES (?, ?, 'legacy', ?, 0)",
+                [(time(), month, total) for month, total in monthly_tokens.items()],
+            )
+        logger.info(f"Imported {len(monthly_tokens)} months from {LEGACY_PATH}")
+
+    def _load_month(self, month: str) -> None:
+        self._month = month
+        self._totals: dict[str, list[int]] = {}
+        rows = self._conn.execute(
+            "SELECT model, SUM(prompt_tokens), SUM(completion_tokens)"
+            " FROM usage WHERE month = ? GROUP BY model",
+            (month,),
+        )
+        for model, prompt_tokens, completion_tokens in rows:
+            self._totals[model] = [prompt_tokens, completion_tokens]
+        self._total = sum(sum(tokens) for tokens in self._totals.values())
+        logger.debug(f"Loaded {self._total} tokens for {month} from the ledger")
+
+    def _roll_month(self) -> None:
+        if (month := this_month()) != self._month:
+            self._load_month(month)
+
+    def add(self, model: str, prompt_tokens: int, completion_tokens: int) -> None:
+        """Records a completion's token usage"""
+        with self._lock:
+            self._roll_month()
+            totals = self._totals.setdefault(model, [0, 0])
+            totals[0] += prompt_tokens
+            totals[1] += completion_tokens
+            self._total += prompt_tokens + completion_tokens
+            # A single row insert is cheap in WAL mode
+            with self._conn:
+                self._conn.execute(
+                    "INSERT INTO usage VALUES (?, ?, ?, ?, ?)",
+                    (time(), self._month, model, prompt_tokens, completion_tokens),
+                )
+
+    def month_total(self) -> int:
+        """This month's total tokens across all models"""
+        with self._lock:
+            self._roll_month()
+            return self._total
+
+    def month_usage(self) -> dict[str, tuple[int, int]]:
+        """This month's (prompt, completion) tokens for each model"""
+        with self._lock:
+            self._roll_month()
+            return {model: tuple(tokens) for model, tokens in self._totals.items()}
@@ -0,0 +1,229 @@
+# Counters and latency histograms, served in the Prometheus text format
+import logging
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+SAMPLES = 1000  # recent observations kept per label set for quantiles
+
+LabelSet = tuple[tuple[str, str], ...]
+
+
+def _label_set(labels: dict[str, str]) -> LabelSet:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(label_set: LabelSet, **extra: str) -> str:
+    pairs = list(label_set) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: dict[LabelSet, float] = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        label_set = _label_set(labels)
+        with self._lock:
+            self._values[label_set] = self._values.get(label_set, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(_label_set(labels), 0)
+
+    def values(self) -> dict[LabelSet, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_set, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(label_set)} {value}")
+        return lines
+
+
+class _HistogramValues:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.samples: deque[float] = deque(maxlen=SAMPLES)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._values: dict[LabelSet, _HistogramValues] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        label_set = _label_set(labels)
+        with self._lock:
+            if (values := self._values.get(label_set)) is None:
+                values = self._values[label_set] = _HistogramValues(self.buckets)
+            values.bucket_counts[bisect_left(self.buckets, value)] += 1
+            values.sum += value
+            values.count += 1
+            values.samples.append(value)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def timed(self, **labels: str) -> Callable:
+        """Decorator that observes how long each call takes"""
+
+        def decorator(func: Callable) -> Callable:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def quantiles(self, *qs: float) -> dict[LabelSet, tuple[float, ...]]:
+        """Quantiles of the recent observations for each label set"""
+        with self._lock:
+            samples = {key: sorted(v.samples) for key, v in self._values.items()}
+        return {
+            label_set: tuple(
+                values[min(int(q * len(values)), len(values) - 1)] for q in qs
+            )
+            for label_set, values in samples.items()
+            if values
+        }
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_set, values in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, values.bucket_counts):
+                    cumulative += count
+                    labels = _format_labels(label_set, le=str(bound))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(label_set, le="+Inf")
+                lines.append(f"{self.name}_bucket{labels} {values.count}")
+                lines.append(f"{self.name}_sum{_format_labels(label_set)} {values.sum}")
+                lines.append(
+                    f"{self.name}_count{_format_labels(label_set)} {values.count}"
+                )
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Counter | Histogram] = {}
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name: str, help: str) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """One line p50/p95 summary of every histogram, for chat"""
+        parts = []
+        for metric in self.metrics.values():
+            if not isinstance(metric, Histogram):
+                continue
+            for label_set, (p50, p95) in metric.quantiles(0.5, 0.95).items():
+                name = metric.name.removesuffix("_seconds")
+                if label_set:
+                    name += "/" + "/".join(value for _, value in label_set)
+                parts.append(f"{name} p50 {p50:.2f}s p95 {p95:.2f}s")
+        return " | ".join(parts)
+
+
+registry = Registry()
+
+api_latency = registry.histogram(
+    "dggpt_api_request_seconds", "Latency of openai and elevenlabs requests"
+)
+http_latency = registry.histogram(
+    "dggpt_http_request_seconds", "Latency of requests to rustlesearch, vyneer etc."
+)
+filter_rejections = registry.counter(
+    "dggpt_bot_filter_rejections_total", "Messages that would trigger the bot filter"
+)
+response_checks = registry.counter(
+    "dggpt_response_checks_total", "Results of the pre response check"
+)
+chat_ttft = registry.histogram(
+    "dggpt_chat_ttft_seconds", "Time to the first token of streamed completions"
+)
+stream_cancellations = registry.counter(
+    "dggpt_stream_cancellations_total", "Streamed completions cancelled by the filter"
+)
+job_wait = registry.histogram(
+    "dggpt_job_wait_seconds", "Time jobs spent waiting in the job and TTS queues"
+)
+jobs_dropped = registry.counter(
+    "dggpt_jobs_dropped_total", "Jobs dropped because their queue was full"
+)
+tts_first_audio = registry.histogram(
+    "dggpt_tts_first_audio_seconds", "Time until the first TTS audio chunk arrives"
+)
+send_delay = registry.histogram(
+    "dggpt_send_delay_seconds", "Time chat messages waited in the outbox"
+)
+summary_stage_latency = registry.histogram(
+    "dggpt_summary_stage_seconds", "Wall time of each stage of a debate summary"
+)
+summary_tokens = registry.counter(
+    "dggpt_summary_tokens_total", "Tokens spent on each stage of debate summaries"
+)
+memory_tokens = registry.counter(
+    "dggpt_memory_tokens_total", "Prompt tokens saved by memory mode and spent on it"
+)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(host: str = "127.0.0.1", port: int = 9071) -> ThreadingHTTPServer:
+    """Serves the registry at http://host:port/metrics from a daemon thread"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,157 @@
+# Sends everything the bot says from one thread, at a rate DGG won't throttle
+import logging
+from enum import IntEnum
+from heapq import heapify, heappop, heappush
+from threading import Condition, Event, Thread
+from time import monotonic, sleep
+from typing import Callable
+from .metrics import jobs_dropped, send_delay
+
+logger = logging.getLogger(__name__)
+
+RATE = 0.5  # messages per second that can be sent for as long as the bot likes
+BURST = 3  # messages that can go out back to back after a quiet spell
+MIN_INTERVAL = 0.5  # DGG throttles messages closer together than this
+QUEUE_SIZE = 32
+
+
+class Priority(IntEnum):
+    ADMIN = 0
+    RESPONSE = 1
+    GAME = 2
+
+
+class Outgoing:
+    """
+    A queued message, sent as one func call per chunk of args.
+    wait() blocks until every chunk has been sent or it was dropped.
+    """
+
+    def __init__(self, priority: Priority, func: Callable, chunks: list[tuple]):
+        self.priority = priority
+        self.func = func
+        self.chunks = chunks
+        self.queued_at = monotonic()
+        self.sent_at: float | None = None
+        self._done = Event()
+
+    def wait(self, timeout: float | None = None) -> float | None:
+        """Returns the monotonic time its first chunk was sent, None if dropped"""
+        self._done.wait(timeout)
+        return self.sent_at
+
+
+class Outbox:
+    """
+    A priority queue of outgoing messages, sent one at a time by a worker thread.
+    Sending is limited by a token bucket, so bursts go out quickly but the
+    bot can't average more than RATE messages a second. Every chunk of a
+    message takes a token, and nothing else is sent until its last chunk is.
+    When the queue is full, the newest message of the lowest priority is dropped.
+    """
+
+    def __init__(
+        self,
+        rate: float = RATE,
+        burst: int = BURST,
+        min_interval: float = MIN_INTERVAL,
+        maxsize: int = QUEUE_SIZE,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.min_interval = min_interval
+        self.maxsize = maxsize
+        self.sent = 0
+        self.dropped = 0
+        self._heap: list[tuple[int, int, Outgoing]] = []
+        self._count = 0
+        self._ready = Condition()
+        self._tokens = float(burst)
+        self._refilled = monotonic()
+        self._last_sent = 0.0
+        Thread(target=self._work, name="outbox", daemon=True).start()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def put(
+        self, func: Callable, *args, priority: Priority = Priority.RESPONSE
+    ) -> Outgoing:
+        """Queues func(*args) to be called once it's this message's turn"""
+        return self.put_chunks(func, [args], priority=priority)
+
+    def put_chunks(
+        self,
+        func: Callable,
+        chunks: list[tuple],
+        priority: Priority = Priority.RESPONSE,
+    ) -> Outgoing:
+        """Queues func(*args) for every args in chunks, to be sent back to back"""
+        outgoing = Outgoing(priority, func, chunks)
+        with self._ready:
+            self._count += 1
+            heappush(self._heap, (priority, self._count, outgoing))
+            if len(self._heap) > self.maxsize:
+                self._drop(max(self._heap))
+            self._ready.notify()
+        return outgoing
+
+    def _drop(self, entry: tuple[int, int, Outgoing]) -> None:
+        self._heap.remove(entry)
+        heapify(self._heap)
+        outgoing = entry[2]
+        outgoing._done.set()
+        self.dropped += 1
+        jobs_dropped.inc(queue="outbox")
+        logger.warning(f"Outbox full, dropped {outgoing.chunks}")
+
+    def stats(self) -> dict[str, int]:
+        with self._ready:
+            return {
+                "depth": len(self._heap),
+                "sent": self.sent,
+                "dropped": self.dropped,
+            }
+
+    def _wait_for_token(self) -> None:
+        while True:
+            now = monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._refilled) * self.rate
+            )
+            self._refilled = now
+            wait = max(
+                (1 - self._tokens) / self.rate,
+                self._last_sent + self.min_interval - now,
+            )
+            if wait <= 0:
+                self._tokens -= 1
+                return
+            sleep(wait)
+
+    def _work(self) -> None:
+        while True:
+            with self._ready:
+                while not self._heap:
+                    self._ready.wait()
+            # Popped after the wait, so anything more urgent can still go first
+            self._wait_for_token()
+            with self._ready:
+                _, _, outgoing = heappop(self._heap)
+            send_delay.observe(
+                monotonic() - outgoing.queued_at, priority=outgoing.priority.name
+            )
+            try:
+                for i, args in enumerate(outgoing.chunks):
+                    if i > 0:
+                        self._wait_for_token()
+                    self._last_sent = monotonic()
+                    outgoing.func(*args)
+                    if outgoing.sent_at is None:
+                        outgoing.sent_at = monotonic()
+                    self.sent += 1
+            except Exception:
+                # The rest of the message wouldn't make sense on its own
+                logger.exception(f"Couldn't send {args}")
+            finally:
+                outgoing._done.set()
@@ -1,9 +1,16 @@
 # Handles all requests that use the requests module
 import logging
-from functools import cache
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Iterator
+from urllib.parse import quote, urlencode, urlsplit
 import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from dggpt.cache import TTLCache, refreshing_cache
+from dggpt.metrics import http_latency
 
 logger = logging.getLogger(__name__)
 
@@ -13,9 +20,37 @@ PHRASE_LINK = "https://vyneer.me/tools/phrases?ts=1"
 EMOTE_LINK = "https://tena.dev/api/emotes"
 STREAM_STATUS_LINK = "https://www.destiny.gg/api/info/stream"
 
+PHRASE_TTL = 60 * 60  # seconds before the phrase list is refetched
+EMOTE_TTL = 6 * 60 * 60  # seconds before the emote list is refetched
+TODAY_TTL = 60  # seconds before today's logs are searched again
+DEBATE_DAYS = 2  # UTC days searched, so debates that cross midnight are found
+
+TIMEOUT = (3.05, 10)  # (connect, read) in seconds
+POOL_SIZE = 4  # connections kept alive per host
+RETRIES = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=("GET",),
+)
+
+session = requests.Session()
+for prefix in ("https://", "http://"):
+    session.mount(
+        prefix,
+        HTTPAdapter(pool_maxsize=POOL_SIZE, pool_block=True, max_retries=RETRIES),
+    )
+
+
+def get(url: str) -> requests.Response:
+    """GETs a url through the shared session, recording latency per host"""
+    with http_latency.time(host=urlsplit(url).netloc):
+        return session.get(url, timeout=TIMEOUT)
+
+
+def parse_phrases(raw_phrases: list[str]) -> tuple[tuple[str], tuple[re.Pattern]]:
+    """Splits phrases into plain ones and /regex/ ones"""
 
-@cache
-def request_phrases() -> tuple[tuple[str], tuple[re.Pattern]]:
     def is_regex(text: str):
         if re.search(r"^/.*/$", text):
             try:
@@ -23,62 +58,153 @@ def request_phrases() -> tuple[tuple[str], tuple[re.Pattern]]:
             except re.error:
                 pass
 
-    logger.debug("Getting phrases from vyneer.me ...")
-    raw_phrases = requests.get(PHRASE_LINK)
     regex_phrases = []
     phrases = []
-    for item in raw_phrases.json()["data"]:
-        if (regex := is_regex(phrase := item["phrase"])) is not None:
+    for phrase in raw_phrases:
+        if (regex := is_regex(phrase)) is not None:
             regex_phrases.append(regex)
         else:
             phrases.append(phrase)
-    logger.debug("Phrases loaded from vyneer.me")
     return tuple(phrases), tuple(regex_phrases)
 
 
-@cache
+@refreshing_cache(ttl=PHRASE_TTL)
+def request_phrases() -> tuple[tuple[str], tuple[re.Pattern]]:
+    logger.debug("Getting phrases from vyneer.me ...")
+    raw_phrases = get(PHRASE_LINK)
+    phrases = parse_phrases([item["phrase"] for item in raw_phrases.json()["data"]])
+    logger.debug("Phrases loaded from vyneer.me")
+    return phrases
+
+
+@refreshing_cache(ttl=EMOTE_TTL)
 def request_emotes() -> tuple:
     """Returns a tuple of all current emotes on tena.dev"""
     logger.debug("Getting emotes from tena.dev ...")
-    emotes = requests.get(EMOTE_LINK).json().keys()
+    emotes = get(EMOTE_LINK).json().keys()
     logger.debug("Emotes loaded from tena.dev")
     return tuple([emote_name for emote_name in emotes])
 
 
+def search_pages(
+    query: dict[str, str], search_after: int | None = None
+) -> Iterator[list[dict]]:
+    """
+    Yields pages of rustlesearch.dev results, newest first.
+    Each page is only fetched once the previous one has been used up.
+    """
+    while True:
+        params = (
+            query if search_after is None else query | {"search_after": search_after}
+        )
+        raw = get(f"{LOG_LINK}?{urlencode(params, quote_via=quote)}").json()
+        if raw.get("error"):
+            raise Exception(f"Error from rustlesearch: {raw['error']}")
+        if not raw["data"] or not (messages := raw["data"]["messages"]):
+            return
+        yield messages
+        if (search_after := messages[-1].get("searchAfter")) is None:
+            return
+
+
+class SearchCursor:
+    """Keeps the results of a search fetched so far, and fetches more on demand"""
+
+    def __init__(self, query: dict[str, str]):
+        self.query = query
+        self.messages: list[dict] = []
+        self.exhausted = False
+        self._pages = search_pages(query)
+        self._lock = Lock()
+
+    def take(self, amount: int) -> list[dict]:
+        """Returns up to amount of the newest messages"""
+        with self._lock:
+            while len(self.messages) < amount and not self.exhausted:
+                try:
+                    page = next(self._pages, None)
+                except Exception:
+                    # A generator that raised is finished, so start a new one
+                    # from the last page that came through
+                    search_after = (
+                        self.messages[-1].get("searchAfter") if self.messages else None
+                    )
+                    self._pages = search_pages(self.query, search_after)
+                    raise
+                if page is None:
+                    self.exhausted = True
+                else:
+                    self.messages.extend(page)
+            return self.messages[:amount]
+
+
+# Past days' logs never change, so their cursors are kept until they're evicted
+past_searches = TTLCache(maxsize=128, ttl=None)
+today_searches = TTLCache(maxsize=32, ttl=TODAY_TTL)
+search_pool = ThreadPoolExecutor(DEBATE_DAYS, thread_name_prefix="rustlesearch")
+
+
+def debate_cursor(nick1: str, nick2: str, day: str) -> SearchCursor:
+    nick1, nick2 = sorted((nick1, nick2), key=str.lower)
+    key = (nick1.lower(), nick2.lower(), day)
+    today = datetime.utcnow().strftime("%Y-%m-%d")
+    cache = today_searches if day >= today else past_searches
+    if (cursor := cache.get(key)) is None:
+        cursor = SearchCursor(
+            {
+                "username": f"{nick1} | {nick2}",
+                "start_date": day,
+                "end_date": day,
+                "channel": "Destinygg",
+                "text": f'"{nick1}" | "{nick2}"',
+            }
+        )
+        cache.set(key, cursor)
+    return cursor
+
+
 def request_debate(
     nick1: str, nick2: str, amount: str | int, day: str = None
 ) -> list | str:
-    """Returns messages from 2 users on rustlesearch.dev where they mention eachother."""
+    """
+    Returns the newest messages from 2 users on rustlesearch.dev where they
+    mention eachother, oldest first. Without a day, the last DEBATE_DAYS are searched.
+    """
     try:
         amount = int(amount)
     except ValueError:
         logger.debug('arg "amount" was given a non int value')
         return "Message amount wasn't an integer MMMM"
-    if not day:
-        day = datetime.utcnow().strftime("%Y-%m-%d")
-    r_link = (
-        f"{LOG_LINK}?username={nick1}%20%7C%20{nick2}"
-        f"&start_date={day}&end_date={day}&channel=Destinygg"
-        f"&text=%22{nick1}%22%20%7C%20%22{nick2}%22"
-    )
-    logger.debug(f"Getting messages from rustlesearch.dev ...")
-    raw = requests.get(r_link).json()
-    if not raw["data"] or not raw["data"]["messages"]:
+    if day:
+        days = [day]
+    else:
+        now = datetime.utcnow()
+        days = [
+            (now - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(DEBATE_DAYS)
+        ]
+    logger.debug(f"Getting messages from rustlesearch.dev for {', '.join(days)} ...")
+    cursors = [debate_cursor(nick1, nick2, day) for day in days]
+    # Older days only make up what the newer ones are short of, but their
+    # first page is fetched alongside in case the newest day is short
+    for cursor in cursors[1:]:
+        search_pool.submit(cursor.take, 1)
+    messages = []
+    for cursor in cursors:
+        if len(messages) >= amount:
+            break
+        messages.extend(cursor.take(amount - len(messages)))
+    if not messages:
         logger.info("No messages found from rustlesearch.dev")
         return "No messages found MMMM"
-    i, debate = 0, []
-    for message in reversed(raw["data"]["messages"]):
-        if i == amount:
-            break
-        debate.append(f'{message["username"]}: {message["text"]}')
-        i += 1
-    logger.debug(f"{amount} messages loaded from rustlesearch.dev")
-    return debate
+    logger.debug(f"{len(messages)} messages loaded from rustlesearch.dev")
+    return [
+        f'{message["username"]}: {message["text"]}' for message in reversed(messages)
+    ]
 
 
 def request_latest_log(user: str) -> str:
     query = f"?channel=Destinygg&username={user}"
-    logs = requests.get(LOG_LINK + query).json()
+    logs = get(LOG_LINK + query).json()
     if logs["error"]:
         raise Exception(f"Error from rustlesearch: {logs['error']}")
     return logs["data"]["messages"][0]
@@ -1,2 +1,3 @@
 # This module is for putting the bot's messages into TTS
 from .tts import generate_tts
+from .formatter import format_tts_message
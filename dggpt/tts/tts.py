@@ -1,24 +1,103 @@
+# Turns text into TTS clips with elevenlabs, only imported once TTS mode is on
 from datetime import datetime
+from collections import deque
+from functools import cache
+from threading import Condition, Thread
+from time import monotonic, perf_counter
+import os
 import logging
 
 from elevenlabs.client import ElevenLabs
-from elevenlabs import save
 
-from dggpt.config import ELEVENLABS_KEY
+from dggpt import config
+from dggpt.metrics import api_latency, job_wait, jobs_dropped, tts_first_audio
 
 logger = logging.getLogger(__name__)
-client = ElevenLabs(api_key=ELEVENLABS_KEY)
 
 VOICE = "Jessica"
 MODEL = "eleven_flash_v2_5"
+QUEUE_SIZE = 4
 
 
-def generate_tts(input: str):
-    """Takes in a string and outputs a TTS"""
-    audio = client.generate(
-        text=input,
-        voice=VOICE,
-        model=MODEL,
+@cache
+def get_client() -> ElevenLabs:
+    """Creates the elevenlabs client the first time it's needed"""
+    return ElevenLabs(
+        api_key=config.ELEVENLABS_KEY, base_url=os.environ.get("ELEVENLABS_BASE_URL")
     )
-    filename = "mp3files/" + datetime.now().strftime("%Y%m%d%H%M%S") + ".mp3"
-    save(audio, filename)
+
+
+def synthesize(text: str) -> str:
+    """
+    Streams a TTS clip into mp3files/ as it's generated, returns the filename.
+    The clip is written to a .part file that's only renamed once it's complete.
+    """
+    filename = "mp3files/" + datetime.now().strftime("%Y%m%d%H%M%S%f") + ".mp3"
+    part_filename = filename + ".part"
+    start = perf_counter()
+    try:
+        with api_latency.time(endpoint="tts"), open(part_filename, "wb") as mp3:
+            audio = get_client().generate(
+                text=text, voice=VOICE, model=MODEL, stream=True
+            )
+            for i, chunk in enumerate(audio):
+                if i == 0:
+                    tts_first_audio.observe(perf_counter() - start)
+                mp3.write(chunk)
+        os.replace(part_filename, filename)
+    except BaseException:
+        if os.path.exists(part_filename):
+            os.remove(part_filename)
+        raise
+    logger.debug(f"Saved TTS to {filename} in {perf_counter() - start:.2f}s")
+    return filename
+
+
+class TTSQueue:
+    """
+    Synthesizes TTS clips one at a time on a worker thread.
+    When the queue is full, the oldest waiting clip is dropped.
+    """
+
+    def __init__(self, maxsize: int = QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._jobs: deque[tuple[str, float]] = deque()
+        self._ready = Condition()
+        Thread(target=self._work, name="tts-worker", daemon=True).start()
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def put(self, text: str) -> None:
+        with self._ready:
+            if len(self._jobs) >= self.maxsize:
+                dropped_text, _ = self._jobs.popleft()
+                self.dropped += 1
+                jobs_dropped.inc(queue="tts")
+                logger.warning(f'TTS queue full, dropped "{dropped_text}"')
+            self._jobs.append((text, monotonic()))
+            self._ready.notify()
+
+    def _work(self) -> None:
+        while True:
+            with self._ready:
+                while not self._jobs:
+                    self._ready.wait()
+                text, queued_at = self._jobs.popleft()
+            job_wait.observe(monotonic() - queued_at, queue="tts")
+            try:
+                synthesize(text)
+            except Exception:
+                logger.exception("TTS synthesis failed")
+
+
+@cache
+def tts_queue() -> TTSQueue:
+    """Starts the TTS worker the first time it's needed"""
+    return TTSQueue()
+
+
+def generate_tts(input: str):
+    """Takes in a string and queues it up to be output as a TTS"""
+    tts_queue().put(input)
@@ -12,9 +12,12 @@ User._name_regex = _name_regex
 
 import os
 import sys
+import signal
 import logging
+from time import monotonic
 from dggbot import Message
 from dggpt import DGGPTBot
+from dggpt.metrics import serve as serve_metrics
 
 sys.tracebacklimit = 0
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
@@ -43,19 +46,37 @@ def tts(msg: Message):
     bot.toggle_tts_mode()
 
 
+@bot.check(bot.is_admin)
+@bot.command()
+def speculate(msg: Message):
+    bot.toggle_speculative_mode()
+
+
+@bot.check(bot.is_admin)
+@bot.command()
+def stream(msg: Message):
+    bot.toggle_stream_mode()
+
+
+@bot.check(bot.is_admin)
+@bot.command()
+def memory(msg: Message):
+    bot.toggle_memory_mode()
+
+
 @bot.event()
 def on_mention(msg: Message):
-    bot.respond_to_mention(msg.nick, msg.data)
+    bot.jobs.submit(bot.respond_to_mention, msg.nick, msg.data)
 
 
 @bot.event()
 def on_msg(msg: Message):
-    bot.process_msg(msg.nick, msg.data)
+    bot.process_msg(msg.nick, msg.data, monotonic())
 
 
 @bot.event()
 def on_privmsg(msg: Message):
-    bot.process_privmsg(msg.nick, msg.data)
+    bot.jobs.submit(bot.process_privmsg, msg.nick, msg.data)
 
 
 @bot.command(cooldown=30)
@@ -71,7 +92,7 @@ def coinflip(msg: Message):
 @bot.check(bot.is_admin)
 @bot.command(cooldown=30)
 def respond(msg: Message, user: str):
-    bot.respond_to_log(user)
+    bot.jobs.submit(bot.respond_to_log, user)
 
 
 @bot.check(bot.is_admin)
@@ -83,13 +104,13 @@ def repeat(msg: Message):
 @bot.check(bot.is_admin)
 @bot.command()
 def summarize(msg: Message, user1: str, user2: str, amount: str = "10"):
-    bot.send_summary(user1, user2, amount)
+    bot.jobs.submit(bot.send_summary, user1, user2, amount)
 
 
 @bot.check(bot.is_admin)
 @bot.command()
 def solve(msg: Message):
-    bot.send_solution()
+    bot.jobs.submit(bot.send_solution)
 
 
 @bot.check(bot.is_admin)
@@ -101,13 +122,13 @@ def clearcache(msg: Message):
 @bot.check(bot.is_admin)
 @bot.command()
 def wipe(msg: Message):
-    bot.clear_convo()
+    bot.jobs.submit(bot.clear_convo)
 
 
 @bot.check(bot.is_admin)
 @bot.command()
 def wipelast(msg: Message):
-    bot.clear_last_prompt()
+    bot.jobs.submit(bot.clear_last_prompt)
 
 
 @bot.check(bot.is_admin)
@@ -156,7 +177,19 @@ def simonsays(msg: Message):
 def generate(msg: Message, prompt: str):
     if not msg.nick == "tena":
         return
-    bot.send_image(prompt=prompt)
+    bot.jobs.submit(bot.send_image, prompt=prompt)
+
+
+@bot.check(bot.is_admin)
+@bot.command()
+def jobs(msg: Message):
+    bot.send_job_stats()
+
+
+@bot.check(bot.is_admin)
+@bot.command()
+def metrics(msg: Message):
+    bot.send_metrics()
 
 
 @bot.command(whisper_only=True)
@@ -165,4 +198,11 @@ def spamcheck(msg: Message):
 
 
 if __name__ == "__main__":
+    # docker stop sends SIGTERM, exiting normally lets the atexit hooks
+    # write the pending config changes and the rest of the journal
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    serve_metrics(
+        os.environ.get("METRICS_HOST", "127.0.0.1"),
+        int(os.environ.get("METRICS_PORT", 9071)),
+    )
     bot.run_forever()